@@ -6,6 +6,21 @@ import os
 import pandas as pd
 import re
 
+# Parts of the file names to replace when creating the sheet names; the 
+# prefix, leading underscores and the file extension are removed
+SHEET_NAME_REPLACEMENTS = {"trad": "traditional", 
+                           "mult": "multiple",
+                           "reg": "regular season",
+                           "play": "playoffs",
+                           "_": " "}
+SHEET_NAME_PATTERN = re.compile(r"^corr__?|\.csv$|trad|mult|reg|play(?=\.csv$)|_")
+
+# Columns identifying a correlation and their (compact) data types
+KEY_COLUMNS = ["Season", "Metric", "PartitionSize", "Part"]
+KEY_DTYPES = {"Season": "int16", "Metric": "category", 
+              "PartitionSize": "int8", "Part": "int8"}
+
+
 def combine_files(file: str) -> pd.DataFrame:
     """
     Combine correlation files created in Python (Pearson/Spearman) with those
@@ -24,17 +39,25 @@ def combine_files(file: str) -> pd.DataFrame:
 
     """
     # Pearson and spearman correlations
-    pear_spear = pd.read_csv(f"../Results/{file}")
+    pear_spear = pd.read_csv(f"../Results/{file}", 
+                             usecols=KEY_COLUMNS + ["Pearson", "Spearman"],
+                             dtype=KEY_DTYPES)
     
     # Find the MIC version of the same file
     mic_equiv = file.replace("corr", "mic")
 
     # MIC values
-    mic = pd.read_csv(f"../Results/{mic_equiv}")
+    mic = pd.read_csv(f"../Results/{mic_equiv}", usecols=KEY_COLUMNS + ["MIC"],
+                      dtype=KEY_DTYPES)
+    
+    # Use the same categories in both data frames such that the merge 
+    # compares category codes
+    metrics = pear_spear["Metric"].cat.categories.union(mic["Metric"].cat.categories)
+    pear_spear["Metric"] = pear_spear["Metric"].cat.set_categories(metrics)
+    mic["Metric"] = mic["Metric"].cat.set_categories(metrics)
     
     # Combine the information about correlations and MIC
-    corr_df = pear_spear.merge(mic, on = ["Season", "Metric", 
-                                          "PartitionSize", "Part"])
+    corr_df = pear_spear.merge(mic, on = KEY_COLUMNS, sort=False)
     
     # Reorder the columns
     corr_df = corr_df[["Season", "Metric", "PartitionSize", "Part", 
@@ -43,6 +66,65 @@ def combine_files(file: str) -> pd.DataFrame:
     return corr_df
 
 
+def combine_all_files() -> dict:
+    """
+    Combine all correlation files with their MIC equivalent.
+
+    Returns
+    -------
+    sheets : dict
+        Key-value pairs of sheet name: data frame with all evaluation metrics,
+        e.g. Multiple playoffs: corr_df of corr_mult_play.csv.
+
+    """
+    # Get all results files regarding correlation
+    with os.scandir("../Results") as entries:
+        files = [entry.name for entry in entries 
+                 if entry.name.startswith(("corr_", "mic_")) and 
+                 entry.name.endswith(".csv")]
+    
+    # Combine the correlation and MIC files for each sheet
+    sheets = {}
+    for file in files:
+        if file.startswith("corr_"):
+            # Create the name of the sheet, e.g. corr_mult_play.csv 
+            # becomes multiple playoffs
+            sheet_name = SHEET_NAME_PATTERN.sub(
+                lambda match: SHEET_NAME_REPLACEMENTS.get(match.group(0), ""), file)
+            
+            # Fix capitalization
+            sheet_name = sheet_name[:1].upper() + sheet_name[1:]
+            
+            # Combine the correlation and MIC file
+            sheets[sheet_name] = combine_files(file)
+            
+    return sheets
+
+
+def corr_to_parquet(file_name: str="correlations"):
+    """
+    Create a .parquet file containing correlations (including MIC) for all 
+    partitions created, where the column Sheet corresponds to the sheets 
+    created by corr_to_excel. Much faster to write and read than .xlsx.
+
+    Parameters
+    ----------
+    file_name : str, default is "correlations"
+        The name of the parquet file to create/overwrite.
+    Returns
+    -------
+    None. Instead, the results are saved in a .parquet file.
+
+    """
+    # Combine all files into one data frame
+    corr_df = pd.concat(combine_all_files(), names=["Sheet"]).\
+        reset_index(level="Sheet").reset_index(drop=True)
+    
+    # Save as a compressed parquet file
+    corr_df.to_parquet(f"../Results/{file_name}.parquet", compression="zstd",
+                       index=False)
+
+
 def corr_to_excel(file_name: str="correlations"):
     """
     Create an .xlsx file containing correlations (including MIC) for all 
@@ -57,65 +139,35 @@ def corr_to_excel(file_name: str="correlations"):
     None. Instead, the results are saved in .xlsx files.
 
     """
-    # Get all results files
-    files = os.listdir("../Results")
-    
-    # Keep only the files regarding correlation
-    files = [corr_file for corr_file in files if (corr_file.startswith("corr_") or
-             corr_file.startswith("mic_")) and corr_file.endswith(".csv")]
+    # Combine the correlation and MIC files for each sheet
+    sheets = combine_all_files()
     
     # Create a xlsxwriter object
     with pd.ExcelWriter(f"../Results/{file_name}.xlsx") as writer:
-        for file in files:
-            if file.startswith("corr_"):
-                # Combine the correlation and MIC file
-                corr_df = combine_files(file)
-                
-                # Create the name of the sheet
-                sheet_name = re.sub("corr_|.csv", "", file)
-                
-                # Replace trad with traditional
-                sheet_name = re.sub("trad", "traditional", sheet_name)
-                
-                # Replace mult with multiple
-                sheet_name = re.sub("mult", "multiple", sheet_name)
-                
-                # Replace reg with regular season
-                sheet_name = re.sub("reg", "regular season", sheet_name)
-                
-                # Replace play with playoffs
-                sheet_name = re.sub("play$", "playoffs", sheet_name)
-                
-                # Remove leading underscores
-                sheet_name = re.sub("^_", "", sheet_name)
-                
-                # Replace underscore with space
-                sheet_name = re.sub("_", " ", sheet_name)
-                
-                # Fix capitalization
-                sheet_name = sheet_name[:1].upper() + sheet_name[1:]
-
-                # Write to the excel file
-                corr_df.to_excel(writer, f"{sheet_name}", index=False)  
+        # Get the xlsxwriter workbook object.
+        workbook  = writer.book
         
-                # Get the xlsxwriter workbook and worksheet objects.
-                workbook  = writer.book
-                worksheet = writer.sheets[f"{sheet_name}"]
-                
-                # Number formatting
-                format_num = workbook.add_format({'num_format': '#,##0.000'})
-
-                # Specify column width for column C
-                worksheet.set_column(1, 1, 12)
-                
-                # Specify column width for column C
-                worksheet.set_column(2, 2, 12)
-                
-                # Specify column width for column E-G
-                worksheet.set_column(4, 6, 10, format_num)
+        # Number formatting
+        format_num = workbook.add_format({'num_format': '#,##0.000'})
+        
+        for sheet_name, corr_df in sheets.items():
+            # Write to the excel file
+            corr_df.to_excel(writer, f"{sheet_name}", index=False)  
+    
+            # Get the xlsxwriter worksheet object.
+            worksheet = writer.sheets[f"{sheet_name}"]
+            
+            # Specify column width for column C
+            worksheet.set_column(1, 1, 12)
+            
+            # Specify column width for column C
+            worksheet.set_column(2, 2, 12)
+            
+            # Specify column width for column E-G
+            worksheet.set_column(4, 6, 10, format_num)
                 
         
             
 if __name__ == "__main__":
-    corr_to_excel()
+    corr_to_parquet()
 
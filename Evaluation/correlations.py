@@ -3,20 +3,36 @@
 # Author: Rasmus Säfvenberg
 
 from scipy import stats
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import product
 sys.path.insert(0, "../Scripts")
-from db import connect_to_db
+from db import create_db_engine
 import pandas as pd
 import numpy as np
+from numba import njit
 
+# Patterns to extract the season, partition size, partition and metric from 
+# the names of the partition tables
+SEASON_PATTERN = re.compile(r"(?<=ranked)(\d+)")
+PARTITION_SIZE_PATTERN = re.compile(r"(\d+)(?=partitions)")
+PARTITION_PATTERN = re.compile(r"(?<=part)(\d+)")
+METRIC_PATTERN = re.compile(r"(?<=weighted_)(\w+?)(?=_ranked)")
+
+
+@lru_cache(maxsize=None)
 def get_table_names(connection):
     """
-    Retrieve all the table names from the database.
+    Retrieve all the table names from the database. The result is cached per
+    connection, such that repeated calls to calculate_correlation query the 
+    database only once.
 
     Parameters
     ----------
-    connection : MySQLconnection as created by db.connect_to_db
-        a connection to the SQL database we are working with.
+    connection : sqlalchemy engine as created by db.create_db_engine
+        a (pooled) connection to the SQL database we are working with.
 
     Returns
     -------
@@ -33,14 +49,16 @@ def get_table_names(connection):
                      FROM INFORMATION_SCHEMA.TABLES
                      WHERE TABLE_TYPE = 'BASE TABLE' AND 
                      TABLE_SCHEMA = 'hockey' AND 
-                     Table_Name LIKE 
+                     Table_Name LIKE %s
                      """
     
     # Create a data frame of all table names for full seasons (and multiple)
-    full_table_names = pd.read_sql(table_query + "'weighted%20__'", con=connection)
+    full_table_names = pd.read_sql(table_query, con=connection, 
+                                   params=("weighted%20__",))
     
     # Create a data frame of all table names for multiple_seasons
-    mult_table_names = pd.read_sql(table_query + "'weighted%20__%20__%'", con=connection)
+    mult_table_names = pd.read_sql(table_query, con=connection, 
+                                   params=("weighted%20__%20__%",))
     
     # Unique table names of multiple seasons
     unique_mult = mult_table_names.TABLE_NAME.str.replace("_playoffs", "").unique()
@@ -49,7 +67,8 @@ def get_table_names(connection):
     full_table_names = full_table_names.loc[~full_table_names.TABLE_NAME.isin(unique_mult)]
     
     # Full season tables (playoffs)
-    full_playoff_table_names = pd.read_sql(table_query + "'weighted%20__%_playoffs'", con=connection)
+    full_playoff_table_names = pd.read_sql(table_query, con=connection,
+                                           params=("weighted%20__%_playoffs",))
     mult_playoffs = full_playoff_table_names.TABLE_NAME.isin(mult_table_names.TABLE_NAME)
     full_playoff_table_names = full_playoff_table_names.loc[~mult_playoffs]
 
@@ -57,13 +76,16 @@ def get_table_names(connection):
     full_table_names = pd.concat([full_table_names, full_playoff_table_names]).sort_values("TABLE_NAME")
 
     # Names of partitioned seasons
-    part_table_names = pd.read_sql(table_query + "'weighted%20__%_part%'", con=connection)
+    part_table_names = pd.read_sql(table_query, con=connection,
+                                   params=("weighted%20__%_part%",))
     # Extract the season
-    part_table_names["season"] = part_table_names.TABLE_NAME.str.extract("(?<=ranked)(\d+)").astype(float)
+    part_table_names["season"] = part_table_names.TABLE_NAME.str.extract(SEASON_PATTERN).astype(float)
     # Extract the partition size
-    part_table_names["partition_size"] = part_table_names.TABLE_NAME.str.extract("(\d+)(?=partitions)").astype(float)
+    part_table_names["partition_size"] = part_table_names.TABLE_NAME.str.extract(PARTITION_SIZE_PATTERN).astype(float)
     # Extract the partition value
-    part_table_names["partition"] = part_table_names.TABLE_NAME.str.extract("(?<=part)(\d+)").astype(float)
+    part_table_names["partition"] = part_table_names.TABLE_NAME.str.extract(PARTITION_PATTERN).astype(float)
+    # Extract the metric
+    part_table_names["metric"] = part_table_names.TABLE_NAME.str.extract(METRIC_PATTERN)
     # Sort values in logical order
     part_table_names.sort_values(["season", "partition_size", "partition"], 
                                  inplace=True)    
@@ -71,12 +93,167 @@ def get_table_names(connection):
     return full_table_names, mult_table_names, part_table_names
     
 
-def correlation(season, metric, n, connection, generalize=False, traditional=False, 
-                mixed=False, playoffs=False, multiple=False, partitioned=False,
-                evaluation_start=None, evaluation_end=None):
+@njit(cache=True, error_model="numpy")
+def corr_coef(x, y):
     """
-    Calculate the correlation coefficients (Pearson/Spearman) for a specific
-    number of partitions, n.
+    Calculate the Pearson correlation coefficient between x and y. Compiled 
+    with numba such that the sums are computed in a single pass.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Array of float values.
+    y : np.ndarray
+        Array of float values of the same length as x.
+
+    Returns
+    -------
+    pear : float
+        The Pearson correlation coefficient.
+
+    """
+    mean_x = x.mean()
+    mean_y = y.mean()
+    
+    # Sum of cross products and sum of squares of the centered values
+    cross = 0.0
+    sum_sq_x = 0.0
+    sum_sq_y = 0.0
+    for k in range(x.size):
+        dx = x[k] - mean_x
+        dy = y[k] - mean_y
+        cross += dx * dy
+        sum_sq_x += dx * dx
+        sum_sq_y += dy * dy
+    
+    # Covariance divided by the product of the standard deviations
+    pear = cross / np.sqrt(sum_sq_x * sum_sq_y)
+    
+    return pear
+
+
+def pearson_spearman(x, y):
+    """
+    Calculate the Pearson and Spearman correlation coefficients between x and y.
+    Unlike stats.pearsonr and stats.spearmanr no p-values are computed and
+    the data is ranked only once.
+
+    Parameters
+    ----------
+    x : array_like
+        The values of the first metric.
+    y : array_like
+        The values of the second metric.
+
+    Returns
+    -------
+    pear : float
+        The Pearson correlation coefficient.
+    spear : float
+        The Spearman correlation coefficient.
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    
+    # Pearson correlation of the values
+    pear = corr_coef(x, y)
+    
+    # Spearman correlation, i.e. Pearson correlation of the (average) ranks
+    spear = corr_coef(stats.rankdata(x), stats.rankdata(y))
+    
+    return pear, spear
+
+
+def pearson_spearman_columns(x, Y):
+    """
+    Calculate the Pearson and Spearman correlation coefficients between x and
+    each column of Y with matrix operations.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Array of float values of length N.
+    Y : np.ndarray
+        Array of float values of shape (N, p).
+
+    Returns
+    -------
+    pearson : np.ndarray
+        The p Pearson correlation coefficients.
+    spearman : np.ndarray
+        The p Spearman correlation coefficients.
+
+    """
+    # Pearson correlation of the values
+    pearson = corr_coef_columns(x, Y)
+    
+    # Spearman correlation, i.e. Pearson correlation of the (average) ranks
+    spearman = corr_coef_columns(stats.rankdata(x), stats.rankdata(Y, axis=0))
+    
+    return pearson, spearman
+
+
+def corr_coef_columns(x, Y):
+    """
+    Calculate the Pearson correlation coefficient between x and each column 
+    of Y.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Array of float values of length N.
+    Y : np.ndarray
+        Array of float values of shape (N, p).
+
+    Returns
+    -------
+    pear : np.ndarray
+        The p Pearson correlation coefficients.
+
+    """
+    x_centered = x - x.mean()
+    Y_centered = Y - Y.mean(axis=0)
+    
+    # Covariances divided by the products of the standard deviations
+    pear = (x_centered @ Y_centered) / np.sqrt((x_centered @ x_centered) * 
+                                               (Y_centered * Y_centered).sum(axis=0))
+    
+    return pear
+
+
+def get_table_name(table_names, pattern, metric):
+    """
+    Get the name of the table of a metric that matches a given pattern.
+
+    Parameters
+    ----------
+    table_names : pd.DataFrame
+        A dataframe with table names as returned by get_table_names.
+    pattern : string
+        Regular expression that the table name should contain.
+    metric : string
+        The name of the metric to consider.
+
+    Returns
+    -------
+    table_name : string
+        The name of the (first) matching table.
+
+    """
+    idx = table_names.TABLE_NAME.str.contains(pattern)
+    metric_idx = table_names.TABLE_NAME.str.contains(f"weighted_{metric.lower()}")
+    table_name = table_names.loc[idx & metric_idx].TABLE_NAME.values[0]
+    
+    return table_name
+
+
+def get_partition_table_names(season, metric, n_partitions, table_names,
+                              playoffs=False, multiple=False, partitioned=False,
+                              evaluation_start=None, evaluation_end=None):
+    """
+    Get the names of the tables of all partitions (1, ..., n_partitions) of 
+    a season for a given metric.
 
     Parameters
     ----------
@@ -86,16 +263,10 @@ def correlation(season, metric, n, connection, generalize=False, traditional=Fal
         Valid inputs are 2007 - 2013.
     metric : string
         The name of the metric to consider.
-    n : integer
-        What partition to consider (if applicable). Currently used {1, ..., 10}
-    connection : MySQLconnection as created by db.connect_to_db
-        a connection to the SQL database we are working with.
-    generalize : boolean, default is False
-        Whether to generalize the results, i.e. n*partition_value
-    traditional : boolean, default is False
-        Whether to consider the generalization of traditional metrics.
-    mixed : boolean, default is False.
-        Whether to consider a mix of weighted and traditional metrics.
+    n_partitions : integer
+       The number of partitions in total.
+    table_names : tuple
+        The table names as returned by get_table_names.
     playoffs : boolean, default is False
         Whether to consider only the playoffs
     multiple : boolean, default is False
@@ -106,138 +277,436 @@ def correlation(season, metric, n, connection, generalize=False, traditional=Fal
         The part on which the occurrences were counted. ("Training data")
     evaluation_end : integer, default is None
         The part on which the evaluation takes place. ("Test data")
-    
 
     Returns
     -------
-    corr_df : pd.DataFrame
-        Data frame of correlation coefficients.
+    partition_tables : list
+        List of tuples (partition size, partition, table name).
 
     """
-
     if multiple and partitioned:
         raise ValueError("Only one of multiple or partitioned can be chosen at a time.")
+    
+    full_tables, multiple_tables, partitioned_tables = table_names
         
-    # Get all table names
-    full_tables, multiple_tables, partitioned_tables = get_table_names(connection)
-
-    # If no partitions should be consider, this is a fail-safe
-    if not partitioned:
-         n = 1
-       
     if playoffs:
         play_table = "_playoffs"
     else:
         play_table = ""
-       
-    # Initialize empty arrays
-    pearson = np.zeros(n)
-    spearman = np.zeros(n)
-    
-    # Loop over all partitions
-    for i in range(1, n+1):
-        # Select the relevant partition
-        if n == 1:
-            if multiple:
-                # Multiple season/parts
-                idx = multiple_tables.TABLE_NAME.str.contains(f"{evaluation_start}_{evaluation_end}{play_table}$") 
-                metric_idx = multiple_tables.TABLE_NAME.str.contains(f"weighted_{metric.lower()}")
-                table_name = multiple_tables.loc[idx & metric_idx].TABLE_NAME.values[0]
-            else:
-                # One full season
-                idx = full_tables.TABLE_NAME.str.contains(f"{season}{play_table}$")
-                metric_idx = full_tables.TABLE_NAME.str.contains(f"weighted_{metric.lower()}")
-                table_name = full_tables.loc[idx & metric_idx].TABLE_NAME.values[0]
-        else:
-            # Partitions
-            idx = partitioned_tables.TABLE_NAME.str.contains(f"{season}_{n}partitions_part{i}")
-            metric_idx = partitioned_tables.TABLE_NAME.str.contains(f"weighted_{metric.lower()}")
-            table_name = partitioned_tables.loc[idx & metric_idx].TABLE_NAME.values[0]
+    
+    # If no partitions should be consider, this is a fail-safe
+    if partitioned:
+        partition_sizes = range(1, n_partitions+1)
         
-        table = pd.read_sql(f"SELECT * FROM {table_name}", connection)
+        # Partition tables of the season and metric by (partition size, partition)
+        season_tables = partitioned_tables.loc[(partitioned_tables.season == season) & 
+                                               (partitioned_tables.metric == metric.lower())]
+        part_lookup = dict(zip(zip(season_tables.partition_size, season_tables.partition), 
+                               season_tables.TABLE_NAME))
+    else:
+        partition_sizes = [1]
         
-        if generalize:
-            # Get the full season data
-            idx = full_tables.TABLE_NAME.str.contains(f"{season}{play_table}$")
-            metric_idx = full_tables.TABLE_NAME.str.contains(f"weighted_{metric.lower()}")
-            full_table_name = full_tables.loc[idx & metric_idx].TABLE_NAME.values[0]
-            
-            full_table = pd.read_sql(f"SELECT * FROM {full_table_name}", connection)
-
-            # Combine the two tables
-            merged_table = full_table.merge(table, 
-                                            on=["PlayerId", "PlayerName", "Position"], 
-                                            how="left")
-            
-            # Replace NA with 0
-            merged_table.fillna(0, inplace=True)
-            
-            # For First_Assists
-            # metric = metric.replace("_", "")
-            
-            if traditional and not mixed: 
-                # Traditional metrics
-                pear, _ = stats.pearsonr(merged_table[f"{metric}_x"], 
-                                         n*merged_table[f"{metric}_y"])
-
-                # Traditional metrics
-                spear, _ = stats.spearmanr(merged_table[f"{metric}_x"], 
-                                           n*merged_table[f"{metric}_y"])
-            
-            # Traditional and generalized weighted
-            elif traditional and mixed:
-                # n * Traditional metrics (x) and weighted metrics (y)
-                pear, _ = stats.pearsonr(merged_table[f"Weighted{metric}_x"], 
-                                         n*merged_table[f"{metric}_y"])
-
-                spear, _ = stats.spearmanr(merged_table[f"Weighted{metric}_x"], 
-                                           n*merged_table[f"{metric}_y"])
-
-            # Generalized traditional and weighted
-            elif not traditional and mixed:
-                # Traditional metrics (x) and n * weighted metrics (y)
-                pear, _ = stats.pearsonr(merged_table[f"{metric}_x"], 
-                                         n*merged_table[f"Weighted{metric}_y"])
-
-                spear, _ = stats.spearmanr(merged_table[f"{metric}_x"], 
-                                           n*merged_table[f"Weighted{metric}_y"])
+    partition_tables = []
+    for n in partition_sizes:
+        for i in range(1, n+1):
+            # Select the relevant partition
+            if n == 1:
+                if multiple:
+                    # Multiple season/parts
+                    table_name = get_table_name(multiple_tables, 
+                                                f"{evaluation_start}_{evaluation_end}{play_table}$",
+                                                metric)
+                else:
+                    # One full season
+                    table_name = get_table_name(full_tables, f"{season}{play_table}$", 
+                                                metric)
             else:
-                # Calculate correlation coefficients between total weighted and n * weighted
-                pear, _ = stats.pearsonr(merged_table[f"Weighted{metric}_x"], 
-                                         n*merged_table[f"Weighted{metric}_y"])
+                # Partitions
+                table_name = part_lookup[(n, i)]
+                
+            partition_tables.append((n, i, table_name))
+    
+    return partition_tables
 
-                spear, _ = stats.spearmanr(merged_table[f"Weighted{metric}_x"], 
-                                           n*merged_table[f"Weighted{metric}_y"])  
-            
-            
+
+def read_partition_tables(season, metric, n_partitions, connection, table_names,
+                          playoffs=False, multiple=False, partitioned=False,
+                          evaluation_start=None, evaluation_end=None):
+    """
+    Read the tables of all partitions (1, ..., n_partitions) of a season for
+    a given metric with one query.
+
+    Parameters
+    ----------
+    season : integer
+        integer value of 4 characters (e.g. 2013)
+        Selects games from the given season.
+        Valid inputs are 2007 - 2013.
+    metric : string
+        The name of the metric to consider.
+    n_partitions : integer
+       The number of partitions in total.
+    connection : sqlalchemy engine as created by db.create_db_engine
+        a (pooled) connection to the SQL database we are working with.
+    table_names : tuple
+        The table names as returned by get_table_names.
+    playoffs : boolean, default is False
+        Whether to consider only the playoffs
+    multiple : boolean, default is False
+        Whether to consider multiple parts worth of data.
+    partitioned : boolean, default is False
+        Whether to consider a partitioned season.
+    evaluation_start : integer, default is None
+        The part on which the occurrences were counted. ("Training data")
+    evaluation_end : integer, default is None
+        The part on which the evaluation takes place. ("Test data")
+
+    Returns
+    -------
+    tables : pd.DataFrame
+        All rows of the partition tables indexed by PlayerId, PlayerName and
+        Position, with the columns PartitionSize and Part identifying the 
+        partition.
+
+    """
+    # One query per partition
+    queries = [f"""SELECT PlayerId, PlayerName, Position, 
+                          {metric}, Weighted{metric}, 
+                          {n} AS PartitionSize, {i} AS Part 
+                   FROM {table_name}""" 
+               for n, i, table_name in get_partition_table_names(
+                       season, metric, n_partitions, table_names, playoffs, 
+                       multiple, partitioned, evaluation_start, evaluation_end)]
+    
+    # Read all partitions at once, with compact integer types for the player 
+    # id and partition identifiers
+    tables = pd.read_sql_query(" UNION ALL ".join(queries), connection,
+                               dtype={"PlayerId": "uint32", metric: "float64",
+                                      f"Weighted{metric}": "float64",
+                                      "PartitionSize": "uint8", "Part": "uint8"})
+    
+    # Index by player
+    tables.set_index(["PlayerId", "PlayerName", "Position"], inplace=True)
+    
+    return tables
+
+
+def correlation_in_db(season, metric, n_partitions, connection, table_names,
+                      playoffs=False, multiple=False, partitioned=False,
+                      evaluation_start=None, evaluation_end=None):
+    """
+    Calculate the correlation coefficients (Pearson/Spearman) between the 
+    traditional and weighted metric for all partitions (1, ..., n_partitions) 
+    of a season in the database, such that only the coefficients are 
+    transferred. Spearman is calculated as Pearson of the average ranks.
+    Requires MySQL 8.0 or later (window functions).
+
+    Parameters
+    ----------
+    season : integer
+        integer value of 4 characters (e.g. 2013)
+        Selects games from the given season.
+        Valid inputs are 2007 - 2013.
+    metric : string
+        The name of the metric to consider.
+    n_partitions : integer
+       The number of partitions in total.
+    connection : sqlalchemy engine as created by db.create_db_engine
+        a (pooled) connection to the SQL database we are working with.
+    table_names : tuple
+        The table names as returned by get_table_names.
+    playoffs : boolean, default is False
+        Whether to consider only the playoffs
+    multiple : boolean, default is False
+        Whether to consider multiple parts worth of data.
+    partitioned : boolean, default is False
+        Whether to consider a partitioned season.
+    evaluation_start : integer, default is None
+        The part on which the occurrences were counted. ("Training data")
+    evaluation_end : integer, default is None
+        The part on which the evaluation takes place. ("Test data")
+
+    Returns
+    -------
+    corr_df : pd.DataFrame
+        Data frame of correlation coefficients, with the columns PartitionSize 
+        and Part identifying the partition.
+
+    """
+    # Pearson correlation from the sums of the values
+    pearson_query = """(COUNT(*) * SUM({x} * {y}) - SUM({x}) * SUM({y})) /
+                       (SQRT(COUNT(*) * SUM({x} * {x}) - SUM({x}) * SUM({x})) * 
+                        SQRT(COUNT(*) * SUM({y} * {y}) - SUM({y}) * SUM({y})))"""
+    
+    # One query per partition
+    queries = [f"""SELECT {n} AS PartitionSize, {i} AS Part, 
+                          {pearson_query.format(x="x", y="y")} AS Pearson,
+                          {pearson_query.format(x="rank_x", y="rank_y")} AS Spearman
+                   FROM 
+                   (SELECT {metric} AS x, Weighted{metric} AS y,
+                           RANK() OVER (ORDER BY {metric}) + 
+                           (COUNT(*) OVER (PARTITION BY {metric}) - 1) / 2.0 AS rank_x,
+                           RANK() OVER (ORDER BY Weighted{metric}) + 
+                           (COUNT(*) OVER (PARTITION BY Weighted{metric}) - 1) / 2.0 AS rank_y
+                    FROM {table_name}) AS ranked""" 
+               for n, i, table_name in get_partition_table_names(
+                       season, metric, n_partitions, table_names, playoffs, 
+                       multiple, partitioned, evaluation_start, evaluation_end)]
+    
+    # Calculate the correlations of all partitions at once
+    corr_df = pd.read_sql(" UNION ALL ".join(queries), connection)
+    
+    return corr_df
+
+
+def read_full_table(season, metric, connection, table_names, playoffs=False):
+    """
+    Read the full season data for a given metric, keeping only the columns 
+    needed to calculate the correlations.
+
+    Parameters
+    ----------
+    season : integer
+        integer value of 4 characters (e.g. 2013)
+        Selects games from the given season.
+        Valid inputs are 2007 - 2013.
+    metric : string
+        The name of the metric to consider.
+    connection : sqlalchemy engine as created by db.create_db_engine
+        a (pooled) connection to the SQL database we are working with.
+    table_names : tuple
+        The table names as returned by get_table_names.
+    playoffs : boolean, default is False
+        Whether to consider only the playoffs
+
+    Returns
+    -------
+    full_table : pd.DataFrame
+        The full season data of the metric, indexed by PlayerId, PlayerName
+        and Position.
+
+    """
+    if playoffs:
+        play_table = "_playoffs"
+    else:
+        play_table = ""
+        
+    # Name of the full season table
+    full_table_name = get_table_name(table_names[0], f"{season}{play_table}$", metric)
+    
+    # Get the full season data, with a compact integer type for the player id
+    full_table = pd.read_sql_query(f"""SELECT PlayerId, PlayerName, Position, 
+                                              {metric}, Weighted{metric} 
+                                       FROM {full_table_name}""", connection,
+                                   dtype={"PlayerId": "uint32", metric: "float64",
+                                          f"Weighted{metric}": "float64"})
+    
+    # Index by player
+    full_table.set_index(["PlayerId", "PlayerName", "Position"], inplace=True)
+    
+    return full_table
+
+
+def correlation(tables, metric, n, full_table=None, generalize=False, 
+                traditional=False, mixed=False):
+    """
+    Calculate the correlation coefficients (Pearson/Spearman) for a specific
+    number of partitions, n.
+
+    Parameters
+    ----------
+    tables : pd.DataFrame
+        The data of all n partitions as returned by read_partition_tables,
+        where the column Part identifies the partition. If generalize is True
+        all partitions are correlated with the full season at once.
+    metric : string
+        The name of the metric to consider.
+    n : integer
+        What partition to consider (if applicable). Currently used {1, ..., 10}
+    full_table : pd.DataFrame, default is None
+        The full season data. Required if generalize is True.
+    generalize : boolean, default is False
+        Whether to generalize the results, i.e. n*partition_value
+    traditional : boolean, default is False
+        Whether to consider the generalization of traditional metrics.
+    mixed : boolean, default is False.
+        Whether to consider a mix of weighted and traditional metrics.
+
+    Returns
+    -------
+    corr_df : pd.DataFrame
+        Data frame of correlation coefficients.
+
+    """
+    if generalize:
+        # For First_Assists
+        # metric = metric.replace("_", "")
+        
+        if traditional and not mixed: 
+            # Traditional metrics
+            x_col, y_col = f"{metric}", f"{metric}"
+        
+        # Traditional and generalized weighted
+        elif traditional and mixed:
+            # n * Traditional metrics (x) and weighted metrics (y)
+            x_col, y_col = f"Weighted{metric}", f"{metric}"
+
+        # Generalized traditional and weighted
+        elif not traditional and mixed:
+            # Traditional metrics (x) and n * weighted metrics (y)
+            x_col, y_col = f"{metric}", f"Weighted{metric}"
         else:
+            # Total weighted and n * weighted
+            x_col, y_col = f"Weighted{metric}", f"Weighted{metric}"
+        
+        # One column per partition, aligned with the players of the full 
+        # season (i.e. a left join)
+        partitions = tables.set_index("Part", append=True)[y_col].unstack("Part").\
+            reindex(full_table.index)
+        
+        # NA replaced with 0 in the arrays rather than the data frames
+        x = np.nan_to_num(full_table[x_col].to_numpy(dtype=np.float64))
+        Y = np.nan_to_num(n*partitions.to_numpy(dtype=np.float64), copy=False)
+        
+        # Calculate correlation coefficients for all partitions at once
+        pearson, spearman = pearson_spearman_columns(x, Y)
+        
+    else:
+        # Initialize empty arrays
+        pearson = np.zeros(n)
+        spearman = np.zeros(n)
+        
+        # Loop over all partitions (each with its own players)
+        for i, table in tables.groupby("Part"):
             # For First_Assists
             # metric = metric.replace("_", "")
             
             # Calculate correlation coefficients between traditional and weighted
-            pear, _ = stats.pearsonr(table[f"{metric}"], 
-                                     table[f"Weighted{metric}"])
-            spear, _ = stats.spearmanr(table[f"{metric}"], 
-                                       table[f"Weighted{metric}"])
-            
-        # Add to the arrays
-        pearson[i-1] = pear
-        spearman[i-1] = spear
+            pear, spear = pearson_spearman(table[f"{metric}"], 
+                                           table[f"Weighted{metric}"])
+                
+            # Add to the arrays
+            pearson[i-1] = pear
+            spearman[i-1] = spear
 
     # Create a data frame having the correlation for each iteration and given metric.
-    corr_df = pd.DataFrame([pearson, spearman]).transpose().\
-            rename(columns={0: "Pearson", 1: "Spearman"})
-    
-    corr_df.index += 1
+    corr_df = pd.DataFrame({"Pearson": pearson, "Spearman": spearman}, 
+                           index=pd.RangeIndex(1, n+1))
     
     return corr_df
 
 
+def init_worker():
+    """
+    Create a separate database engine in each worker process, since the 
+    connections of the main process can not be shared.
+
+    Returns
+    -------
+    None. The engine is stored in the global variable connection.
+
+    """
+    global connection
+    connection = create_db_engine("hockey", pool_pre_ping=True)
+
+
+def season_metric_correlation(season, metric, n_partitions, table_names,
+                              generalize=False, traditional=False, mixed=False,
+                              playoffs=False, multiple=False, partitioned=False,
+                              evaluation_end=None, in_database=False):
+    """
+    Calculate the correlations (Pearson/Spearman) of all partitions for a 
+    given season and metric.
+
+    Parameters
+    ----------
+    season : integer
+        integer value of 4 characters (e.g. 2013)
+        Selects games from the given season.
+        Valid inputs are 2007 - 2013. If multiple is True, this is the part 
+        on which the occurrences were counted. ("Training data")
+    metric : string
+        The name of the metric to consider.
+    n_partitions : integer
+       The number of partitions in total.
+    table_names : tuple
+        The table names as returned by get_table_names.
+    generalize : boolean, default is False
+        Whether to generalize the results, i.e. n*partition_value
+    traditional : boolean, default is False
+        Whether to consider the generalization of traditional metrics.
+    mixed : boolean, default is False.
+        Whether to consider a mix of weighted and traditional metrics.
+    playoffs : boolean, default is False
+        Whether to consider only the playoffs
+    multiple : boolean, default is False
+        Whether to consider multiple parts worth of data.
+    partitioned : boolean, default is False
+        Whether to consider a partitioned season.
+    evaluation_end : integer, default is None
+        The part on which the evaluation takes place. ("Test data")
+    in_database : boolean, default is False
+        Whether to calculate the correlations in the database (MySQL 8.0 or 
+        later). Not applicable if generalize is True.
+
+    Returns
+    -------
+    metric_df : pd.DataFrame
+        Data frame of the correlations for the season and metric.
+
+    """
+    # Calculate the correlations in the database when possible
+    in_database = in_database and not generalize
+    
+    if in_database:
+        # Correlations of all partitions of the season for the given metric
+        db_corr = correlation_in_db(season, metric, n_partitions, connection,
+                                    table_names, playoffs, multiple, 
+                                    partitioned, season, evaluation_end)
+    else:
+        # All partitions of the season for the given metric
+        tables = read_partition_tables(season, metric, n_partitions, connection,
+                                       table_names, playoffs, multiple, 
+                                       partitioned, season, evaluation_end)
+    
+    if generalize:
+        # Get the full season data (once for all partitions)
+        full_table = read_full_table(season, metric, connection, 
+                                     table_names, playoffs)
+    else:
+        full_table = None
+    
+    # Empty list for the correlations of each partition size
+    metric_dfs = []
+    for part in range(1, n_partitions+1):
+        # If no partitions should be consider, this is a fail-safe
+        n = part if partitioned else 1
+        
+        # Correlation for each season, metric and partition part
+        if in_database:
+            corr_df = db_corr.loc[db_corr.PartitionSize == n, 
+                                  ["Part", "Pearson", "Spearman"]].\
+                set_index("Part").rename_axis(None)
+        else:
+            corr_df = correlation(tables.loc[tables.PartitionSize == n], metric, n,
+                                  full_table, generalize, traditional, mixed)
+        
+        metric_dfs.append(corr_df.assign(Metric=metric, 
+                                         PartitionSize=part, 
+                                         Season=season))
+    
+    # Combine the partitions of the metric
+    metric_df = pd.concat(metric_dfs).reset_index().\
+        rename(columns={"index": "Part"})
+        
+    return metric_df
+
+
 def calculate_correlation(metric_list, season_list=None, n_partitions=1,
                           generalize=False, traditional=False, mixed=False,
                           playoffs=False, multiple=False, partitioned=False,
-                          evaluation_start=None, evaluation_end=None
-                          ):
+                          evaluation_start=None, evaluation_end=None,
+                          n_jobs=1, use_threads=False, in_database=False):
     """
     Calculate the correlations (Pearson/Spearman) for all metrics in 
     the metric_list.
@@ -266,6 +735,16 @@ def calculate_correlation(metric_list, season_list=None, n_partitions=1,
         The part on which the occurrences were counted. ("Training data")
     evaluation_end : integer, default is None
         The part on which the evaluation takes place. ("Test data")
+    n_jobs : integer, default is 1
+        The number of processes used to calculate the correlations of the
+        (season, metric) pairs. Each process opens its own connection.
+    use_threads : boolean, default is False
+        Whether to use threads instead of processes when n_jobs > 1. The 
+        threads share the pooled connection, which is preferable when most 
+        of the time is spent waiting for the database (e.g. in_database).
+    in_database : boolean, default is False
+        Whether to calculate the correlations in the database (MySQL 8.0 or 
+        later). Not applicable if generalize is True.
     
 
     Returns
@@ -274,9 +753,6 @@ def calculate_correlation(metric_list, season_list=None, n_partitions=1,
         Data frame of all correlations.
 
     """
-    # Empty dictionary for season and metrics
-    corr = {}
-    
     if season_list is not None:
         iterable = season_list
     else:
@@ -290,40 +766,47 @@ def calculate_correlation(metric_list, season_list=None, n_partitions=1,
                 raise TypeError("No iterable found for either season_list or evaluation_start.")
         
         
-    # Loop over all seasons
-    for season in iterable:
-        # Empty dictionary for the season
-        corr[season] = {}
-        curr_eval = season
-        # Go over all metrics
-        for metric in metric_list:
-            metric_df = pd.DataFrame()
-            for part in range(1, n_partitions+1):
-                # Correlation for each season, metric and partition part
-                metric_df = metric_df.append(
-                    correlation(season, metric, part, connection, 
-                                generalize, traditional, mixed, playoffs, 
-                                multiple, partitioned,
-                                curr_eval, evaluation_end).\
-                                             assign(Metric=metric, 
-                                                    PartitionSize=part, 
-                                                    Season=season))
-                    
-            # Save the metric for the season
-            corr[season][metric] = metric_df.reset_index().\
-                rename(columns={"index": "Part"})
-        # Combine all metric and season data into one data frame per season
-        corr[season] = pd.concat(corr[season])
+    # Get all table names
+    table_names = get_table_names(connection)
+    
+    # All combinations of season and metric
+    seasons, metrics = zip(*product(iterable, metric_list))
+    
+    # Arguments shared by all seasons and metrics
+    season_metric_corr = partial(season_metric_correlation, 
+                                 n_partitions=n_partitions, table_names=table_names,
+                                 generalize=generalize, traditional=traditional, 
+                                 mixed=mixed, playoffs=playoffs, multiple=multiple,
+                                 partitioned=partitioned, evaluation_end=evaluation_end,
+                                 in_database=in_database)
+    
+    if n_jobs == 1:
+        # Correlations for each season and metric
+        corr = [season_metric_corr(season, metric) 
+                for season, metric in zip(seasons, metrics)]
+    elif use_threads:
+        # Correlations for each season and metric, distributed over threads
+        # that each check out their own connection from the pool
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            corr = list(executor.map(season_metric_corr, seasons, metrics))
+    else:
+        # Correlations for each season and metric, distributed over processes
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker) as executor:
+            corr = list(executor.map(season_metric_corr, seasons, metrics))
         
-    # Combine all correlations into one season
+    # Combine all correlations into one data frame
     corr = pd.concat(corr).reset_index(drop=True)
     
     return corr
 
 
 if __name__ == "__main__": 
-    # Connect to the database
-    connection = connect_to_db("hockey")
+    # Connect to the database, reusing the pooled connection for all queries
+    connection = create_db_engine("hockey", pool_pre_ping=True)
+    
+    # Number of processes to use, each with its own connections to the 
+    # database. Set to e.g. os.cpu_count() to calculate in parallel.
+    n_jobs = 1
     
     # Define the list of metrics to consider
     metric_list = ["Goals", "Assists", "First_Assists", "PlusMinus", "Points"]
@@ -334,14 +817,16 @@ if __name__ == "__main__":
                                            season_list=range(2007, 2014),
                                            n_partitions=10,
                                            generalize=False, traditional=False,
-                                           playoffs=False, partitioned=True)
+                                           playoffs=False, partitioned=True,
+                                           n_jobs=n_jobs)
     
     # Correlation within playoffs
     corr_playoffs = calculate_correlation(metric_list, 
                                           season_list=range(2007, 2014),
                                           n_partitions=1,
                                           generalize=False, 
-                                          traditional=False, playoffs=True)
+                                          traditional=False, playoffs=True,
+                                          n_jobs=n_jobs)
     
     # Correlation within multiple seasons (regular season)
     corr_mult_reg = calculate_correlation(metric_list, 
@@ -349,7 +834,8 @@ if __name__ == "__main__":
                                           generalize=False, traditional=False, 
                                           playoffs=False, multiple=True,
                                           evaluation_start=range(2007, 2013),
-                                          evaluation_end=2013)
+                                          evaluation_end=2013,
+                                          n_jobs=n_jobs)
     
     # Correlation within multiple seasons (playoffs)
     corr_mult_play = calculate_correlation(metric_list, 
@@ -357,7 +843,8 @@ if __name__ == "__main__":
                                            generalize=False, traditional=False, 
                                            playoffs=True, multiple=True,
                                            evaluation_start=range(2007, 2013),
-                                           evaluation_end=2013)
+                                           evaluation_end=2013,
+                                           n_jobs=n_jobs)
 
     
     # Correlation between n*weighted and weighted
@@ -365,14 +852,16 @@ if __name__ == "__main__":
                                                  season_list=range(2007, 2014),
                                                  n_partitions=10,
                                                  generalize=True, traditional=False, 
-                                                 playoffs=False, partitioned=True)
+                                                 playoffs=False, partitioned=True,
+                                                 n_jobs=n_jobs)
     
     # Correlation between n*traditional and traditional
     corr_generalize_trad = calculate_correlation(metric_list,
                                                  season_list=range(2007, 2014),
                                                  n_partitions=10,
                                                  generalize=True, traditional=True,
-                                                 playoffs=False, partitioned=True)
+                                                 playoffs=False, partitioned=True,
+                                                 n_jobs=n_jobs)
     
     # Correlation between n*traditional and weighted
     corr_generalize_trad_GPIV = calculate_correlation(metric_list,
@@ -380,7 +869,8 @@ if __name__ == "__main__":
                                                       n_partitions=10,
                                                       generalize=True, traditional=True,
                                                       mixed=True,
-                                                      playoffs=False, partitioned=True)
+                                                      playoffs=False, partitioned=True,
+                                                      n_jobs=n_jobs)
     
     # Correlation between n*GPIV and traditional
     corr_generalize_GPIV_trad = calculate_correlation(metric_list,
@@ -388,7 +878,8 @@ if __name__ == "__main__":
                                                       n_partitions=10,
                                                       generalize=True, traditional=False,
                                                       mixed=True,
-                                                      playoffs=False, partitioned=True)
+                                                      playoffs=False, partitioned=True,
+                                                      n_jobs=n_jobs)
     
     # Save as csv files
     corr_trad_GPIV.to_csv(           "../Results/corr_trad_GPIV.csv", index=False)
@@ -2,9 +2,19 @@
 # -*- coding: utf-8 -*-
 # Author: Rasmus Säfvenberg
 
+import re
 import pandas as pd
 from db import connect_to_db
 
+# Column names of the metrics, by their (lower case) name in the table names
+METRIC_NAMES = {"goals": "Goals", "assists": "Assists", 
+                "first_assists": "First_Assists", "points": "Points", 
+                "plusminus": "PlusMinus"}
+
+# Patterns to extract the metric and season from the table names
+METRIC_PATTERN = re.compile(r"weighted|ranked|\d{4}|(?<!first)_")
+SEASON_PATTERN = re.compile(r"(\d{4})")
+
 
 def get_player_rankings(connection, season: int, 
                         metric: str, position: list=None) -> pd.DataFrame:
@@ -21,8 +31,7 @@ def get_player_rankings(connection, season: int,
     metric : str
         The metric to consider (Goals, Assists, First_Assists, Points, PlusMinus).
     position : list, default is None.
-        A list of the position(s) to subset. Currently supports two positions 
-        at a time.
+        A list of the position(s) to subset.
 
     Returns
     -------
@@ -30,25 +39,29 @@ def get_player_rankings(connection, season: int,
         Data frame with all players ranked according to GPIV metric.
 
     """
+    # Column name of the metric
+    metric_name = METRIC_NAMES.get(metric.lower(), metric)
+    
+    # Only the rankings, the player and the metric (e.g. not the goals and 
+    # assists of points)
+    columns = f"""Rank_trad, Rank_w, Rank_diff, PlayerId, PlayerName, Position,
+                  {metric_name}, Weighted{metric_name}"""
 
     if position is not None:
-        if len(position) == 1:
-            # Get the players for a given position ranked according to a specific position
-            query = f"""SELECT * FROM weighted_{metric}_ranked{season} 
-                        WHERE Position = '{position[0]}' 
-                        ORDER BY weighted{metric} DESC"""
-        else: 
-            query = f"""SELECT * FROM weighted_{metric}_ranked{season} 
-                        WHERE Position = '{position[0]}' OR
-                              Position = '{position[1]}'
-                        ORDER BY weighted{metric} DESC"""
+        # Get the players for the given position(s) ranked according to a specific position
+        placeholders = ", ".join(["%s"] * len(position))
+        query = f"""SELECT {columns} FROM weighted_{metric}_ranked{season} 
+                    WHERE Position IN ({placeholders})
+                    ORDER BY weighted{metric} DESC"""
+        params = tuple(position)
     else: 
         # Get all players, regardless of position
-        query = f"""SELECT * FROM weighted_{metric}_ranked{season} 
+        query = f"""SELECT {columns} FROM weighted_{metric}_ranked{season} 
                     ORDER BY weighted{metric} DESC"""
+        params = None
                     
     # Save as pandas data frame
-    player_rankings = pd.read_sql(query, con=connection)
+    player_rankings = pd.read_sql(query, con=connection, params=params)
                 
     return player_rankings            
 
@@ -84,48 +97,42 @@ def write_to_excel(connection, position: list=None, file_name: str="GPIV"):
     
     # Name of all metrics
     metrics = table_names["TABLE_NAME"].str.\
-        replace("weighted|ranked|\d{4}|(?<!first)_", "", regex=True).unique()
+        replace(METRIC_PATTERN, "", regex=True).unique()
 
     # Name/year of all seasons 
     seasons = table_names["TABLE_NAME"].str.\
-        extract("(\d{4})").stack().droplevel(1).unique()            
+        extract(SEASON_PATTERN).stack().droplevel(1).unique()            
 
     for metric in metrics:
-        with pd.ExcelWriter(f"../Results/{file_name}-{metric}.xlsx") as writer:
+        with pd.ExcelWriter(f"../Results/{file_name}-{metric}.xlsx", 
+                            engine="xlsxwriter") as writer:
+            # Get the xlsxwriter workbook object
+            workbook = writer.book
+            
+            # Number formatting (shared by all sheets)
+            format_num = workbook.add_format({'num_format': '#,##0.000'})
+            
             for season in seasons:
                 # Get the ranking for the given season and metric
                 ranking = get_player_rankings(connection, season, metric, position)
 
-                # Special case for the first assists metrics
-                if metric.lower() == "first_assists":
-                    metric = "First_Assists"
-                else: 
-                    metric = metric.capitalize()
+                # Column name of the metric
+                metric_name = METRIC_NAMES[metric]
                 
                 # Rename columns
                 ranking.rename(columns={"Rank_trad": "Trad. rank",
                                         "Rank_w": "GPIV rank",
                                         "Rank_diff": "Rank diff.",
-                                        f"Weighted{metric}": 
-                                        f"GPIV {metric}"}, 
+                                        f"Weighted{metric_name}": 
+                                        f"GPIV {metric_name}"}, 
                                inplace=True)
                 
-                # Remove additional columns (goals/assists) from points
-                if metric.lower() == "points":
-                    ranking.drop(["Goals", "WeightedGoals", 
-                                  "Assists", "WeightedAssists"], 
-                                 axis=1, inplace=True)
-                
                 # Write to the excel file
                 ranking.to_excel(writer, f"{season}-{int(season)+1}", 
                                  index=False)  
                 
-                # Get the xlsxwriter workbook and worksheet objects.
-                workbook  = writer.book
+                # Get the xlsxwriter worksheet object
                 worksheet = writer.sheets[f"{season}-{int(season)+1}"]
-                
-                # Number formatting
-                format_num = workbook.add_format({'num_format': '#,##0.000'})
 
                 # Specify column width for column A-C
                 worksheet.set_column(0, 2, 10)
@@ -1,13 +1,33 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from bs4 import BeautifulSoup
+import os
+import lxml.html
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-import re
 import numpy as np
 from db import connect_to_db, create_db_engine
 
+# Team acronyms and the corresponding team names in the SQL database
+TEAM_NAMES = {"ANA": "ANAHEIM DUCKS", "ARI": "ARIZONA COYOTES", 
+              "ATL": "ATLANTA THRASHERS", "BOS": "BOSTON BRUINS", 
+              "BUF": "BUFFALO SABRES", "CAR": "CAROLINA HURRICANES",
+              "CBJ": "COLUMBUS BLUE JACKETS", "CGY": "CALGARY FLAMES", 
+              "CHI": "CHICAGO BLACKHAWKS", "COL": "COLORADO AVALANCHE", 
+              "DAL": "DALLAS STARS", "DET": "DETROIT RED WINGS", 
+              "EDM": "EDMONTON OILERS", "FLA": "FLORIDA PANTHERS", 
+              "LAK": "LOS ANGELES KINGS", "MIN": "MINNESOTA WILD", 
+              "MTL": "MONTREAL CANADIENS", "NJD": "NEW JERSEY DEVILS",
+              "NSH": "NASHVILLE PREDATORS", "NYI": "NEW YORK ISLANDERS", 
+              "NYR": "NEW YORK RANGERS", "OTT": "OTTAWA SENATORS", 
+              "PHI": "PHILADELPHIA FLYERS", "PHX": "PHOENIX COYOTES",
+              "PIT": "PITTSBURGH PENGUINS", "SJS": "SAN JOSE SHARKS", 
+              "STL": "ST. LOUIS BLUES", "TBL": "TAMPA BAY LIGHTNING", 
+              "TOR": "TORONTO MAPLE LEAFS", "VAN": "VANCOUVER CANUCKS",
+              "WPG": "WINNIPEG JETS", "WSH": "WASHINGTON CAPITALS"}
+
 
 def extract_game_information(game):
     """
@@ -18,8 +38,8 @@ def extract_game_information(game):
     
     Parameters
     ----------
-    game : string
-        A string representation of the html tags returned by soup.find_all().
+    game : lxml.html.HtmlElement
+        A table row (html tag) of a game as returned by tree.xpath().
 
     Returns
     -------
@@ -27,24 +47,25 @@ def extract_game_information(game):
         Key-value pairs with attribute: value, e.g. pen_min: 10.
 
     """
-    # Extract the data columns
-    game_data = [i for i in game.split() if re.findall("href|data-stat", i)]
-    
-    # Remove html tags not wanted
-    game_data = [re.sub("\"|td|tr|/a|<a|/|<|boxscores|\.html|teams|", "", 
-            re.sub("[>]", " ", i.split("=")[1])) for 
-         i in game_data][2:]
-    
-    # Remove some unwanted list elements and combine into a new list
-    game_data = ["date " + game_data[0][:8], game_data[2] + game_data[3][:3]] + game_data[4:]
-    
-    # Convert to a dict of key value pairs with nan for missing values
-    game_data = {i.split()[0]: i.split()[1] if len(i.split()) != 1 else np.nan for i in game_data}
+    game_data = {}
+    # The data columns, identified by their data-stat attribute
+    for cell in game.iterfind(".//td"):
+        stat = cell.get("data-stat")
+        
+        if stat == "date_game":
+            # Date from the link to the box score, e.g. /boxscores/200709290ANA.html
+            game_data["date"] = cell.find(".//a").get("href").split("/")[-1][:8]
+        elif stat == "opp_name":
+            # Team acronym from the link to the opponent, e.g. /teams/LAK/2008.html
+            game_data["opp_name"] = cell.find(".//a").get("href").split("/")[2]
+        elif stat != "game_location":
+            # Value of the column with nan for missing values
+            game_data[stat] = str(cell.text_content()) or np.nan
     
     return game_data
 
 
-def scrape_team_gamelogs(team, season):
+def scrape_team_gamelogs(team, season, session=requests):
     """
     Scrape the gamelogs for a team during a given season from 
     hockey-reference.com
@@ -57,6 +78,9 @@ def scrape_team_gamelogs(team, season):
         Team acronym of length 3.
     season : integer
         Numeric value of length 4 indicating season.
+    session : requests.Session, default is requests
+        The session used to get the page, such that connections can be 
+        reused between requests.
 
     Returns
     -------
@@ -65,23 +89,20 @@ def scrape_team_gamelogs(team, season):
 
     """
     # Get the gamelogs for a given team during a given season
-    page = requests.get(f"https://www.hockey-reference.com/teams/{team}/{season}_gamelog.html")
+    page = session.get(f"https://www.hockey-reference.com/teams/{team}/{season}_gamelog.html")
     
     # Parse HTML
-    soup = BeautifulSoup(page.text, "html.parser")
+    tree = lxml.html.fromstring(page.content)
     
     # Find all gamelogs
-    gamelogs = soup.find_all("tr", id=re.compile("^tm_gamelog"))
+    gamelogs = tree.xpath('//tr[starts-with(@id, "tm_gamelog")]')
     
-    # Convert bs4 tags to string representation
-    gamelogs = [str(i) for i in gamelogs]
-
     # Empty dictionary
     game_list = {}
     # Extract the needed information from each game
     for game in gamelogs:
         # Extract the game identifier, e.g. "rs.1" or "po.12"
-        game_id = re.sub('\"', "", game[19:24])
+        game_id = game.get("id").replace("tm_gamelog_", "")
         # Store the game information
         game_list[game_id] = extract_game_information(game)
     
@@ -133,7 +154,8 @@ def check_table_exists(connection, tablename="gamelogs"):
     return table_exists
 
 
-def add_gamelogs_to_db(connection, engine):
+def add_gamelogs_to_db(connection, engine, max_workers=8, 
+                       cache_file="../Data/gamelogs.parquet"):
     """
     Add a new table, gamelogs, to the database with information over
     GameId and corresponding dates.
@@ -146,6 +168,11 @@ def add_gamelogs_to_db(connection, engine):
         a connection to the SQL database we are working with.
     engine : sqlalchemy enginge as creadted by db.create_db_engine
         an engine object such that we can use pd.to_sql() function.
+    max_workers : integer, default is 8
+        The number of gamelogs to scrape concurrently.
+    cache_file : string, default is "../Data/gamelogs.parquet"
+        Parquet file in which the scraped gamelogs are stored. If it exists, 
+        the gamelogs are read from it instead of being scraped again.
 
     Returns
     -------
@@ -153,66 +180,44 @@ def add_gamelogs_to_db(connection, engine):
 
     """
 
-    # List of all teams
-    team_list = ['ANA', 'ARI', 'ATL', 'BOS', 'BUF', 'CAR', 'CBJ', 'CGY', 'CHI', 
-                 'COL', 'DAL', 'DET', 'EDM', 'FLA', 'LAK', 'MIN', 'MTL', 'NJD', 
-                 'NSH', 'NYI', 'NYR', 'OTT', 'PHI', 'PHX', 'PIT', 'SJS', 'STL', 
-                 'TBL', 'TOR', 'VAN', 'WPG', 'WSH']
-    
-    # Team names in the SQL database
-    team_names = ['ANAHEIM DUCKS', 'ARIZONA COYOTES', 'ATLANTA THRASHERS', 
-                  'BOSTON BRUINS', 'BUFFALO SABRES', 'CAROLINA HURRICANES',
-                  'COLUMBUS BLUE JACKETS', 'CALGARY FLAMES', 'CHICAGO BLACKHAWKS',
-                  'COLORADO AVALANCHE', 'DALLAS STARS', 'DETROIT RED WINGS', 
-                  'EDMONTON OILERS', 'FLORIDA PANTHERS', 'LOS ANGELES KINGS',
-                  'MINNESOTA WILD', 'MONTREAL CANADIENS', 'NEW JERSEY DEVILS',
-                  'NASHVILLE PREDATORS', 'NEW YORK ISLANDERS', 'NEW YORK RANGERS',
-                  'OTTAWA SENATORS', 'PHILADELPHIA FLYERS', 'PHOENIX COYOTES',
-                  'PITTSBURGH PENGUINS', 'SAN JOSE SHARKS', 'ST. LOUIS BLUES',
-                  'TAMPA BAY LIGHTNING', 'TORONTO MAPLE LEAFS', 'VANCOUVER CANUCKS',
-                  'WINNIPEG JETS', 'WASHINGTON CAPITALS']
-    
-    # List of all seasons
-    season_list = list(range(2008, 2015))
-    
-    season_gamelog_dict = {}
-    # Loop over all seasons to cover all seasons of interest
-    for season in season_list:
-        # Placeholder value
-        season_gamelog_dict[season] = {}
+    if os.path.exists(cache_file):
+        # Gamelogs scraped previously
+        season_gamelog = pd.read_parquet(cache_file)
+    else:
+        # List of all seasons
+        season_list = list(range(2008, 2015))
+        
+        # All teams during all seasons of interest
+        team_seasons = [(team, season) for season in season_list for team in TEAM_NAMES
+                        # Skip teams that do not exist in a given season
+                        if not ((season <= 2014 and team == "ARI") or
+                                (season >= 2015 and team == "PHX") or
+                                (season <= 2011 and team == "WPG") or
+                                (season >= 2012 and team == "ATL"))]
+        
+        # One session for all requests, such that the connections are reused
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=max_workers, 
+                                              pool_maxsize=max_workers,
+                                              max_retries=3))
+        
+        # Get gamelogs for all teams and seasons, a few pages at a time
+        with session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            gamelogs = list(executor.map(lambda team_season: 
+                                         scrape_team_gamelogs(*team_season, session),
+                                         team_seasons))
         
-        # Loop over all teams to get their gamelogs
-        for team in team_list:
-            # Skip teams that do not exist in a given season
-            if (season <= 2014 and team == "ARI") or \
-               (season >= 2015 and team == "PHX") or \
-               (season <= 2011 and team == "WPG") or \
-               (season >= 2012 and team == "ATL"):
-                continue
-            
-            # Get gamelogs for specific team
-            df = scrape_team_gamelogs(team, season)
-            # Save the gamelog
-            season_gamelog_dict[season][team] = df
-    
-    # All seasons in one data frame
-    season_gamelog = pd.DataFrame()
-    
-    for season in season_list:
-        # Combine the nested dataframes for each team
-        season_gamelog = season_gamelog.append(
-            pd.concat(season_gamelog_dict[season]).\
-                reset_index(level=0, drop=True).reset_index()                    
-            )
+        # All seasons in one data frame, with the game identifier as a column
+        season_gamelog = pd.concat(gamelogs).reset_index()
+        
+        # Store the scraped gamelogs, such that they only have to be scraped once
+        season_gamelog.to_parquet(cache_file, index=False)
     
     #season_gamelog.to_csv("gamelogs.csv", index=False)
     
-    # Team acronym to team name mapping 
-    team_name_mapping = dict(zip(team_list, team_names))
-    
     # Re-map the team names to match that of the database
-    season_gamelog["team_name"] = season_gamelog["team_name"].map(team_name_mapping)
-    season_gamelog["opp_name"] = season_gamelog["opp_name"].map(team_name_mapping)
+    season_gamelog["team_name"] = season_gamelog["team_name"].map(TEAM_NAMES)
+    season_gamelog["opp_name"] = season_gamelog["opp_name"].map(TEAM_NAMES)
     
     # Read the "team" table from the database
     team_query = "SELECT TeamId, TeamName FROM team"
@@ -253,27 +258,16 @@ def merge_id_and_date(connection, engine):
         SELECT pl.GameId, min(gl.date) as date 
         FROM hockey.gamelogs as gl
         RIGHT JOIN
-        	(SELECT even.GameId, team_id, opp_id, gd, opp_gd, shots, shots_against, 
-                    pen_min, pen_min_opp, season
-        	 FROM
-        		(SELECT TeamId as team_id, GameId, GoalDifference as gd, 
-                        TotalShots as shots, PenaltyMinutes as pen_min, 
-                        SUBSTR(GameId, 1, 4) as season
-        		 FROM
-        			(SELECT *, ROW_NUMBER() OVER (ORDER BY GameId) as row_num # Create row numbering
-        			FROM plays_in) as p
-         	 	 WHERE p.row_num % 2 != 0 # Uneven rows, i.e. "team"
-        		 ) as even
-        	INNER JOIN
-        		(SELECT GameId, TeamId as opp_id, GoalDifference as opp_gd, 
-                        TotalShots as shots_against, PenaltyMinutes as pen_min_opp
-        		 FROM
-        			(SELECT *, ROW_NUMBER() OVER (ORDER BY GameId) as row_num # Create row numbering
-        			 FROM plays_in) as p
-        		 WHERE p.row_num % 2 = 0 # Even rows, i.e. "opponent team"
-        		 ) as uneven
-        	ON even.GameId = uneven.GameId	
-            WHERE even.season >= 2007 AND even.season < 2014  # AND SUBSTR(even.GameId, 5, 2) = "02"
+        	(SELECT team.GameId, team.TeamId as team_id, opp.TeamId as opp_id, 
+                    team.GoalDifference as gd, opp.GoalDifference as opp_gd, 
+                    team.TotalShots as shots, opp.TotalShots as shots_against, 
+                    team.PenaltyMinutes as pen_min, opp.PenaltyMinutes as pen_min_opp, 
+                    SUBSTR(team.GameId, 1, 4) as season
+        	 FROM plays_in as team
+        	 INNER JOIN plays_in as opp
+        	 ON team.GameId = opp.GameId 
+             AND team.TeamId < opp.TeamId # One row per game, i.e. "team" and "opponent team"
+             WHERE team.GameId >= 2007000000 AND team.GameId < 2014000000  # AND SUBSTR(team.GameId, 5, 2) = "02"
         ) as pl 
         ON gl.team_id = pl.team_id 
         AND gl.opp_id = pl.opp_id 
@@ -314,17 +308,27 @@ def merge_id_and_date(connection, engine):
                      2007020315: 20071123
                      }
 
-    # Replace the NA values
-    game_id_dates.loc[game_id_dates.date.isna(), "date"] = list(date_fix_dict.values())
+    # Replace the NA values by the date of the corresponding GameId
+    game_id_dates["date"] = game_id_dates["date"].fillna(game_id_dates["GameId"].map(date_fix_dict))
+    
+    # Store the dates as integers (yyyymmdd), such that date ranges are 
+    # compared as numbers and can use the index on the date
+    game_id_dates["date"] = pd.to_numeric(game_id_dates["date"]).astype("Int64")
     
     # Save it in the database
     game_id_dates.to_sql("gamedate", engine, if_exists='replace',
                          chunksize=25000, index=False)
+    
+    # Index the dates by GameId, such that they are looked up by index when 
+    # joined with the play by play data
+    cursor = connection.cursor()
+    cursor.execute("CREATE INDEX ix_gamedate_gameid ON gamedate(GameId, date)")
 
 
 def create_pbp_view(connection):   
     """
-    Create a view of the considered play by play data.
+    Create a materialized view, i.e. an indexed table called 'pbp_mat', of 
+    the considered play by play data.
     
     Author: Rasmus Säfvenberg
 
@@ -339,19 +343,25 @@ def create_pbp_view(connection):
     """
     cursor = connection.cursor(buffered=True)
     
-    # Drop the view if it already exists
-    drop_query = "DROP VIEW IF EXISTS pbp_view"
-    cursor.execute(drop_query)
+    # Drop the view (from earlier versions) and the table if they already exist
+    cursor.execute("DROP VIEW IF EXISTS pbp_view")
+    cursor.execute("DROP TABLE IF EXISTS pbp_mat")
     
-    # Create a view of play by play data with the date added
-    query = """CREATE VIEW pbp_view AS
+    # Create a table of play by play data with the date added
+    query = """CREATE TABLE pbp_mat AS
                SELECT pbp.*, g.date FROM play_by_play_events as pbp
                INNER JOIN gamedate as g
                ON g.GameId = pbp.GameId
                WHERE pbp.GameId > 2007010000;"""
+    cursor.execute(query)
     
-    # Commit changes
+    # Index the table on the columns used to select games
+    query = """ALTER TABLE pbp_mat 
+               ADD INDEX ix_pbp_gameid (GameId), 
+               ADD INDEX ix_pbp_date (date)"""
     cursor.execute(query)
+    
+    # Commit changes
     connection.commit()
 
 
@@ -376,9 +386,10 @@ if __name__ == "__main__":
         # Merge the GameId and dates
         merge_id_and_date(connection, engine)
     
-    #Check if the view 'pbp_view' already exists
-    view_exists = check_table_exists(connection, tablename="pbp_view")
+    #Check if the materialized view 'pbp_mat' already exists
+    view_exists = check_table_exists(connection, tablename="pbp_mat")
     
-    if not view_exists:    
-        # Creat a view for the play by play data 
+    # Refresh it whenever the gamelogs (and thereby the dates) were just added
+    if not view_exists or not table_exists:    
+        # Creat a materialized view for the play by play data 
         create_pbp_view(connection)
\ No newline at end of file
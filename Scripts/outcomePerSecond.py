@@ -2,17 +2,97 @@
 # -*- coding: utf-8 -*-
 
 import pandas as pd
+import numpy as np
 from db import connect_to_db, create_db_engine
-from tqdm import tqdm
 
-# Register tqdm to work with pandas
-tqdm.pandas()
+# The possible outcomes of a game
+OUTCOMES = ["win", "loss", "tie-win", "tie-loss"]
+
+
+def count_outcomes(states, start, end, TotalElapsedTime, GD, MD):
+    """
+    Count all occurrences of the respective outcomes among the game states 
+    that are active at the given times, for the given goal and manpower 
+    difference. Both the home and away team perspective are counted.
+
+    Author: Rasmus Säfvenberg
+    
+    Parameters
+    ----------
+    states : pandas.DataFrame
+        The play by play events that make up the game states, with the 
+        columns GD, MD, Outcome, GDaway, MDaway and OutcomeAway.
+    start : array_like
+        The time after which each event is the state of its game.
+    end : array_like
+        The time up to which (inclusive) each event is the state of its game.
+    TotalElapsedTime : array_like
+        The total elapsed times at which to count the occurrences.
+    GD : array_like
+        The goal difference to count the occurrences of at each time.
+    MD : array_like
+        The manpower difference to count the occurrences of at each time.
+
+    Returns
+    -------
+    counts : pandas.DataFrame
+        A data frame with the count of occurrences of each outcome (columns)
+        at each time (rows).
 
-def occ_before(df, TotalElapsedTime, GD, MD, PeriodNumber):
+    """
+    # Distinct times, such that the active states can be counted by a cumulative sum
+    times = np.unique(TotalElapsedTime)
+    
+    # The first time at which each state is active and the first time thereafter
+    # at which it is no longer active
+    first = np.searchsorted(times, start, side="right")
+    last = np.searchsorted(times, end, side="right")
+    
+    # Distinct combinations of goal and manpower difference to count
+    differences = pd.MultiIndex.from_arrays([np.asarray(GD, dtype=np.float64), 
+                                             np.asarray(MD, dtype=np.float64)])
+    unique_differences = differences.unique()
+    
+    # Change in the number of active states for each combination of difference
+    # and outcome (rows) at each time (columns)
+    changes = np.zeros((len(unique_differences) * len(OUTCOMES), len(times) + 1),
+                       dtype=np.int64)
+    
+    # Home and away team perspective
+    for gd, md, outcome in [("GD", "MD", "Outcome"), 
+                            ("GDaway", "MDaway", "OutcomeAway")]:
+        # The combination of difference and outcome of each state
+        state_differences = pd.MultiIndex.from_arrays(
+            [states[gd].to_numpy(dtype=np.float64), 
+             states[md].to_numpy(dtype=np.float64)])
+        difference_idx = unique_differences.get_indexer(state_differences)
+        outcome_idx = pd.Index(OUTCOMES).get_indexer(states[outcome])
+        
+        # Only states of interest that are active at any of the times
+        keep = (difference_idx >= 0) & (outcome_idx >= 0) & (first < last)
+        rows = difference_idx[keep] * len(OUTCOMES) + outcome_idx[keep]
+        
+        # The state is added when it becomes active and removed thereafter
+        np.add.at(changes, (rows, first[keep]), 1)
+        np.add.at(changes, (rows, last[keep]), -1)
+    
+    # Number of active states at each time
+    active = changes.cumsum(axis=1)
+    
+    # Look up the occurrences of each outcome for each time and difference
+    rows = unique_differences.get_indexer(differences)[:, None] * len(OUTCOMES) + \
+        np.arange(len(OUTCOMES))
+    cols = np.searchsorted(times, TotalElapsedTime)[:, None]
+    counts = pd.DataFrame(active[rows, cols], columns=OUTCOMES)
+    
+    return counts
+
+
+def occ_before(df, goals):
     """
     Count all occurrences of the respective outcomes:
         [Win/Loss (Regulation) & Tie-win/Tie-loss (Overtime)]
-    prior to the goal being scored.
+    prior to each goal being scored.
 
     Author: Rasmus Säfvenberg
     
@@ -20,57 +100,41 @@ def occ_before(df, TotalElapsedTime, GD, MD, PeriodNumber):
     ----------
     df : pandas.DataFrame
         The play by play data frame with the necessary columns.
-    TotalElapsedTime : integer
-        The total elapsed time in-game when the goal was scored.
-    GD : integer
-        The goal difference for the scoring team when the goal was scored.
-    MD : integer
-        The manpower difference for the scoring team when the goal was scored.
-    PeriodNumber : integer
-        The period number in which the goal occurred.
+    goals : pandas.DataFrame
+        The goals, with the total elapsed time (TotalElapsedTime), goal 
+        difference (GD) and manpower difference (MD) when they were scored.
 
     Returns
     -------
     before : pandas.DataFrame
-        A data frame with count of occurence for each combination of total 
-        elapsed time, goal difference and manpower difference before the goal
-        was scored.
+        A data frame with count of occurence of each outcome (columns) for 
+        each goal (rows), given the total elapsed time, goal difference and 
+        manpower difference before the goal was scored.
 
     """
+    # Events after the start of the game
+    states = df[df["TotalElapsedTime"] > 0]
+    time = states["TotalElapsedTime"]
+    game_id = states["GameId"]
     
-    # Get prior-goal events closest to time of the goal and keep only the last per game
-    before_general = df[(df["TotalElapsedTime"] < TotalElapsedTime) & 
-                        (df["TotalElapsedTime"] > 0)].\
-        drop_duplicates("GameId", keep="last")
-    	
-    # Get the required goal and manpower difference for home team perspective
-    before_home = before_general[(before_general["GD"] == GD) & 
-                                 (before_general["MD"] == MD)]
-    	
-    # Count number of occurences for home team
-    before_home = before_home.Outcome.value_counts()
-    					
-    # Get the required goal and manpower difference for away team perspective
-    before_away = before_general[(before_general["GDaway"] == GD) &
-                                 (before_general["MDaway"] == MD)]
-    	
-    # Count number of occurences for away team
-    before_away = before_away.OutcomeAway.value_counts()
+    # The earliest time among the later events of the same game
+    later_time = time[::-1].groupby(game_id[::-1]).cummin()[::-1].\
+        groupby(game_id).shift(-1).fillna(np.inf)
     
-    # Combine home and away perspective											 
-    before = before_home.append(before_away)
+    # An event is the last event prior to a goal (the state of its game) if 
+    # the goal was scored after it, but not after any later event in the game
+    before = count_outcomes(states, time.to_numpy(), later_time.to_numpy(),
+                            goals["TotalElapsedTime"].to_numpy(), 
+                            goals["GD"].to_numpy(), goals["MD"].to_numpy())
     
-    # Sum up the values
-    before = before.groupby(before.index).sum()
-    	
     return before
 
 
-def occ_after(df, TotalElapsedTime, GD, MD, PeriodNumber):
+def occ_after(df, states_after):
     """
     Count all occurrences of the respective outcomes:
         [Win/Loss (Regulation) & Tie-win/Tie-loss (Overtime)]
-    after the goal was scored.
+    after each goal was scored.
 
     Author: Rasmus Säfvenberg
     
@@ -78,48 +142,34 @@ def occ_after(df, TotalElapsedTime, GD, MD, PeriodNumber):
     ----------
     df : pandas.DataFrame
         The play by play data frame with the necessary columns.
-    TotalElapsedTime : integer
-        The total elapsed time in-game when the goal was scored.
-    GD : integer
-        The goal difference for the scoring team when the goal was scored.
-    MD : integer
-        The manpower difference for the scoring team when the goal was scored.
-    PeriodNumber : integer
-        The period number in which the goal occurred.
+    states_after : pandas.DataFrame
+        The events following the goals, with the total elapsed time 
+        (TotalElapsedTime), goal difference (GD) and manpower difference (MD).
 
     Returns
     -------
     after : pandas.DataFrame
-        A data frame with count of occurence for each combination of total 
-        elapsed time, goal difference and manpower difference after the goal
-        was scored.
+        A data frame with count of occurence of each outcome (columns) for 
+        each goal (rows), given the total elapsed time, goal difference and 
+        manpower difference after the goal was scored.
 
     """
-    # Get post-goal events closest to time of the goal and keep only the first per game
-    after_general = df[(df["TotalElapsedTime"] >= TotalElapsedTime) &
-                       (df["EventType"] != "GOAL")].\
-        drop_duplicates("GameId", keep="first")
+    # Events that are not goals
+    states = df[df["EventType"] != "GOAL"]
+    time = states["TotalElapsedTime"]
+    game_id = states["GameId"]
     
-    # Get the required goal and manpower difference for home team perspective
-    after_home = after_general[(after_general["GD"] == GD) & 
-                               (after_general["MD"] == MD)]
-    	
-    # Count number of occurences for home team
-    after_home = after_home.Outcome.value_counts()
+    # The latest time among the earlier events of the same game
+    earlier_time = time.groupby(game_id).cummax().\
+        groupby(game_id).shift(1).fillna(-np.inf)
+    
+    # An event is the first event after a goal (the state of its game) if it 
+    # is not before the goal, but every earlier event in the game is
+    after = count_outcomes(states, earlier_time.to_numpy(), time.to_numpy(),
+                           states_after["TotalElapsedTime"].to_numpy(), 
+                           states_after["GD"].to_numpy(), 
+                           states_after["MD"].to_numpy())
     
-    # Get the required goal and manpower difference for away team perspective
-    after_away = after_general[(after_general["GDaway"] == GD) & 
-                               (after_general["MDaway"] == MD)]
-    	
-    # Count number of occurences for away team
-    after_away = after_away.OutcomeAway.value_counts()
-    	
-    # Combine home and away perspective											 
-    after = after_home.append(after_away)
-    	
-    # Sum up the values
-    after = after.groupby(after.index).sum()
-    	
     return after
 
 
@@ -152,12 +202,12 @@ def count_occurrences(connection, engine, multiple_parts=False,
     """
     # If the data is to be evaluated on another season/data set
     if multiple_parts:
-        original_pbp_table = pbp_table
-        pbp_table += "_eval"
+        eval_pbp_table = pbp_table + "_eval"
+    else:
+        eval_pbp_table = pbp_table
         
-    # Query to retrieve all the needed data from the play by play table
-    query = f"""SELECT Outcome, OutcomeAway, GameId, HomeTeamId, AwayTeamId, 
-                ScoringTeamId, EventNumber, EventType, PeriodNumber, TotalElapsedTime, 
+    # Query to retrieve the game states from the play by play table
+    query = f"""SELECT Outcome, OutcomeAway, GameId, EventType, TotalElapsedTime, 
                 GoalDiff AS GD, GoalDiffAway AS GDaway,
                 ManpowerDiff AS MD, ManpowerDiffAway AS MDaway
                 FROM {pbp_table}
@@ -165,71 +215,72 @@ def count_occurrences(connection, engine, multiple_parts=False,
 	
     # All play by play events as a data frame
     df = pd.read_sql(query, con=connection)
+    
+    # Compact types for the outcomes, event types and differences
+    df = df.astype({"Outcome": "category", "OutcomeAway": "category", 
+                    "EventType": "category"})
+    for col in ["GD", "GDaway", "MD", "MDaway"]:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    
+    # Query to retrieve the goals to evaluate
+    goal_query = f"""SELECT GameId, HomeTeamId, ScoringTeamId, TotalElapsedTime, 
+                     GoalDiff AS GD, GoalDiffAway AS GDaway,
+                     ManpowerDiff AS MD, ManpowerDiffAway AS MDaway
+                     FROM {eval_pbp_table}
+                     WHERE TotalElapsedTime >= 0 AND EventType = 'GOAL'
+                     ORDER BY GameId, EventNumber"""
     	
-    # Subset only the goals
-    df_goals = df[df["EventType"] == "GOAL"].copy()
-
-    # If the data is to be evaluated on another season/data set
-    if multiple_parts:
-        query = query.replace(f"{pbp_table}", f"{original_pbp_table}")
-        df_eval = df.copy(deep=True)
-        df = pd.read_sql(query, con=connection)
+    # Only the goals
+    df_goals = pd.read_sql(goal_query, con=connection)
     
     # Occurences prior to goal
-    before = df_goals.progress_apply(lambda row: occ_before(df, row.TotalElapsedTime, 
-                                                            row.GD, row.MD, 
-                                                            row.PeriodNumber), axis=1)
+    before = occ_before(df, df_goals)
     print("Finished before occurrences!")
 
-    # Get state after goal (i.e. the face-off usually)
-    state_after = pd.DataFrame()
-    for row in df_goals.itertuples(index=False):
-        if multiple_parts:
-            state_after = pd.concat([state_after, 
-                                     df_eval[(df_eval["GameId"] == row.GameId) & 
-                                             (df_eval["EventNumber"] == row.EventNumber+1)]])
+    # Query to retrieve the state after each goal (i.e. the face-off usually),
+    # with one row per goal in the same order as the goals
+    state_after_query = f"""SELECT a.TotalElapsedTime, 
+                            a.GoalDiff AS GD, a.ManpowerDiff AS MD
+                            FROM {eval_pbp_table} AS g
+                            LEFT JOIN {eval_pbp_table} AS a
+                            ON a.GameId = g.GameId AND a.EventNumber = g.EventNumber + 1
+                               AND a.TotalElapsedTime >= 0
+                            WHERE g.TotalElapsedTime >= 0 AND g.EventType = 'GOAL'
+                            ORDER BY g.GameId, g.EventNumber"""
     
-        else:
-            state_after = pd.concat([state_after, 
-                                     df[(df["GameId"] == row.GameId) & 
-                                        (df["EventNumber"] == row.EventNumber+1)]])
+    # Get state after goal
+    state_after = pd.read_sql(state_after_query, con=connection)
+    
+    # Goals without a following event (e.g. at the end of the data) have no 
+    # state after the goal, so their occurrences after the goal are missing
+    has_state_after = state_after["TotalElapsedTime"].notna().to_numpy()
     
     # Occurences after goal
-    after = state_after.progress_apply(lambda row: occ_after(df, row.TotalElapsedTime, 
-                                                             row.GD, row.MD, 
-                                                             row.PeriodNumber), axis=1)
+    after = occ_after(df, state_after[has_state_after]).\
+        set_index(np.flatnonzero(has_state_after)).reindex(range(len(state_after)))
     
     print("Finished after occurrences!")
 
-    # Boolean series of whether the home team scored
-    homeTeamScored = df_goals["ScoringTeamId"] == df_goals["HomeTeamId"]
+    # Boolean array of whether the home team scored
+    homeTeamScored = df_goals["ScoringTeamId"].to_numpy() == df_goals["HomeTeamId"].to_numpy()
     
     # Goal difference from the perspective of the scoring team
-    df_goals.loc[homeTeamScored, "GD_scoring_team"] = df_goals.loc[homeTeamScored, "GD"]
-    df_goals.loc[~homeTeamScored, "GD_scoring_team"] = df_goals.loc[~homeTeamScored, "GDaway"]
+    df_goals["GD_scoring_team"] = np.where(homeTeamScored, df_goals["GD"], df_goals["GDaway"])
 
     # Manpower difference from the perspective of the scoring team
-    df_goals.loc[homeTeamScored, "MD_scoring_team"] = df_goals.loc[homeTeamScored, "MD"]
-    df_goals.loc[~homeTeamScored, "MD_scoring_team"] = df_goals.loc[~homeTeamScored, "MDaway"]
+    df_goals["MD_scoring_team"] = np.where(homeTeamScored, df_goals["MD"], df_goals["MDaway"])
     
     # Create occurence data frame with game id and total elapsed time
     occ_df = df_goals.loc[:, ["GameId", "TotalElapsedTime", 
                               "GD_scoring_team", "MD_scoring_team"]].copy().\
         reset_index(drop=True)
 
-    # Reset index to align with before and after
-    homeTeamScored.reset_index(drop=True, inplace=True)
-    
-    # Remove NA and reorder columns
-    before = before.fillna(0)[["win", "loss", "tie-win", "tie-loss"]].reset_index(drop=True)
-    after = after.fillna(0)[["win", "loss", "tie-win", "tie-loss"]].reset_index(drop=True)
-    
     # Change place of win and loss if the away team scored
-    before.loc[~homeTeamScored, ["win", "loss", "tie-win", "tie-loss"]] = \
-        before.loc[~homeTeamScored, ["loss", "win", "tie-loss", "tie-win"]].values
-
-    after.loc[~homeTeamScored, ["win", "loss", "tie-win", "tie-loss"]] = \
-        after.loc[~homeTeamScored, ["loss", "win", "tie-loss", "tie-win"]].values    
+    for occ in [before, after]:
+        for win, loss in [("win", "loss"), ("tie-win", "tie-loss")]:
+            win_scoring_team = np.where(homeTeamScored, occ[win], occ[loss])
+            loss_scoring_team = np.where(homeTeamScored, occ[loss], occ[win])
+            occ[win], occ[loss] = win_scoring_team, loss_scoring_team
         
     # Add before goal occurences to the data frame
     occ_df[["win_before", "loss_before", 
@@ -250,6 +301,10 @@ def count_occurrences(connection, engine, multiple_parts=False,
     # Commit to SQL
     occ_df.to_sql("occurrences", engine, if_exists='replace', 
     			  chunksize=25000, index=False)
+    
+    # Index the goals on the columns used to join them with event_goal
+    cursor = connection.cursor()
+    cursor.execute("CREATE INDEX ix_occ_game_time ON occurrences(GameId, TotalElapsedTime)")
     	
 
 if __name__ == "__main__":
@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import numpy as np
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from db import connect_to_db, create_db_engine
 
 
@@ -56,15 +55,27 @@ def cut_play_by_play(connection, season=None, start_date=None, end_date=None,
     drop_query = f"""DROP TABLE IF EXISTS {pbp_table}"""
     cursor.execute(drop_query)
 
+    # Count number of players on the ice at any given time for each side as 
+    # the number of set bits in a mask with one bit per player slot.
+    manpower = {side: "BIT_COUNT(" + " | \n        ".join(
+                    f"({side}Player{i} IS NOT NULL) << {i-1}" 
+                    for i in range(1, 10)) + ")"
+                for side in ["Home", "Away"]}
+
     # Initialize a new play by play table in order to keep the original 
-    # play by play table unchanged.
+    # play by play table unchanged. The columns to be filled later are 
+    # declared here as well, so that no ALTER TABLE has to rebuild the table.
+    # Manpower only depends on the players of each row and is therefore 
+    # computed on read by virtual generated columns.
     query = f"""CREATE TABLE {pbp_table}(
         GameId INT(11),
         AwayTeamId INT(11), HomeTeamId INT(11),
         ActionSequence INT(11), EventNumber INT(11),
         PeriodNumber INT(11),
-        EventTime TIME, EventType TEXT,
+        EventTime TIME, TotalElapsedTime INT(11), 
+        EventType TEXT, ScoringTeamId INT(11),
         ExternalEventId INT(11),
+        OutcomeAway TEXT, Outcome TEXT,
         AwayPlayer1 INT(11), AwayPlayer2 INT(11), AwayPlayer3 INT(11),
         AwayPlayer4 INT(11), AwayPlayer5 INT(11), AwayPlayer6 INT(11),
         AwayPlayer7 INT(11), AwayPlayer8 INT(11), AwayPlayer9 INT(11),
@@ -72,15 +83,41 @@ def cut_play_by_play(connection, season=None, start_date=None, end_date=None,
         HomePlayer4 INT(11), HomePlayer5 INT(11), HomePlayer6 INT(11),
         HomePlayer7 INT(11), HomePlayer8 INT(11), HomePlayer9 INT(11),
         Date INT(11),
-        PRIMARY KEY(GameId, EventNumber)
+        TimeBin TEXT,
+        GoalsAgainst INT(11), GoalsFor INT(11), 
+        GoalDiff INT(11), GoalDiffAway INT(11),
+        ManpowerAway INT(11) AS ({manpower["Away"]}) VIRTUAL, 
+        ManpowerHome INT(11) AS ({manpower["Home"]}) VIRTUAL, 
+        ManpowerDiff INT(11) AS (ManpowerHome - ManpowerAway) VIRTUAL, 
+        ManpowerDiffAway INT(11) AS (ManpowerAway - ManpowerHome) VIRTUAL
     ) """
     cursor.execute(query)
     
     # Copy data from the pre-existing play by play table for the given season
-    # and dates
+    # and dates. The values are passed as parameters to the query.
     query = f"""INSERT INTO {pbp_table}
-                SELECT *
-                FROM pbp_view WHERE """
+                (GameId, AwayTeamId, HomeTeamId,
+                ActionSequence, EventNumber, PeriodNumber,
+                EventTime, EventType, ExternalEventId,
+                AwayPlayer1, AwayPlayer2, AwayPlayer3, 
+                AwayPlayer4, AwayPlayer5, AwayPlayer6,
+                AwayPlayer7, AwayPlayer8, AwayPlayer9,
+                HomePlayer1, HomePlayer2, HomePlayer3, 
+                HomePlayer4, HomePlayer5, HomePlayer6,
+                HomePlayer7, HomePlayer8, HomePlayer9,
+                Date)
+                SELECT GameId, AwayTeamId, HomeTeamId,
+                ActionSequence, EventNumber, PeriodNumber,
+                EventTime, EventType, ExternalEventId,
+                AwayPlayer1, AwayPlayer2, AwayPlayer3, 
+                AwayPlayer4, AwayPlayer5, AwayPlayer6,
+                AwayPlayer7, AwayPlayer8, AwayPlayer9,
+                HomePlayer1, HomePlayer2, HomePlayer3, 
+                HomePlayer4, HomePlayer5, HomePlayer6,
+                HomePlayer7, HomePlayer8, HomePlayer9,
+                Date
+                FROM pbp_mat WHERE """
+    params = ()
     
     # If playoffs are to be examined
     if playoffs: 
@@ -90,94 +127,42 @@ def cut_play_by_play(connection, season=None, start_date=None, end_date=None,
     
     # Matches between two dates
     if start_date is not None and end_date is not None:
+        query += "Date BETWEEN %s AND %s"
         if multiple_parts:
             if start_date_evaluation is not None:
                 # start_date to start_date_evaluation
-                query += f"Date BETWEEN '{start_date}' AND '{int(start_date_evaluation)-1}'"
+                params = (start_date, int(start_date_evaluation)-1)
             else: 
                 # start_date_evaluation to end_date
-                query += f"Date BETWEEN '{start_date}' AND '{end_date}'"
+                params = (start_date, end_date)
         else:
-            query += f"Date BETWEEN '{start_date}' AND '{end_date}'"
+            params = (start_date, end_date)
     else:
         # Multiple parts/seasons
         if multiple_parts:
+            query += "GameId > %s AND GameId < %s" + playoffs_query
             if evaluation_season is not None:
                 # all seasons until evaluation season
-                query += f"""GameId > {season}020000 AND 
-                             GameId < {evaluation_season}020000""" + playoffs_query
+                params = (int(f"{season}020000"), 
+                          int(f"{evaluation_season}020000"))
             else:
                 # full evaluation_season
-                query += f"""GameId > {season}020000 AND 
-                             GameId < {season+1}020000""" + playoffs_query 
+                params = (int(f"{season}020000"), int(f"{season+1}020000"))
         elif not multiple_parts and season is not None: 
-            query += f"GameId LIKE '{season}%'" + playoffs_query
+            query += "GameId LIKE CONCAT(%s, '%')" + playoffs_query
+            params = (str(season), )
         # Get all the data
         else: 
             query += "1=1"    
-    cursor.execute(query)
-
-    # Add new columns to be filled later
-    column_query = f"""ALTER TABLE {pbp_table} 
-    ADD TimeBin TEXT,
-    ADD GoalsAgainst INT(11), ADD GoalsFor INT(11), 
-    ADD GoalDiff INT(11), ADD GoalDiffAway INT(11),
-    ADD ManpowerAway INT(11), ADD ManpowerHome INT(11), 
-    ADD ManpowerDiff INT(11), ADD ManpowerDiffAway INT(11), 
-    ADD Outcome TEXT AFTER ExternalEventId,
-    ADD OutcomeAway TEXT AFTER ExternalEventId"""
-    cursor.execute(column_query)
     
-    # Commit all changes
-    connection.commit()
+    # Execute the query as a prepared statement
+    prepared_cursor = connection.cursor(prepared=True)
+    prepared_cursor.execute(query, params)
 
-
-def add_manpower(connection, pbp_table="mpbp"):
-    """
-    Counts the number of players on the ice and sets manpower fields in the 
-    SQL table.
-    
-    Author: Jon Vik
-    Updates by: Rasmus Säfvenberg
-
-    Parameters
-    ----------
-    connection : MySQLconnection as created by db.connect_to_db
-        a connection to the SQL database we are working with.
-    pbp_table : string.
-        Name of the play by play SQL table to be altered. The default is "mpbp".
-
-    Returns
-    -------
-    None. The related changes are instead pushed to the SQL database.
-
-    """
-    # Create a cursor to executy queries
-    cursor = connection.cursor(buffered=True)
-    
-    # The possible sides for the teams.
-    sides = ["Home", "Away"]
-    
-    for side in sides:
-        # Count number of players on the ice at any given time.
-        mp_query = f"""
-        UPDATE {pbp_table} SET ManPower{side} = 
-        (
-        CASE WHEN {side}Player1 IS NOT NULL THEN 1 ELSE 0 END + 
-        CASE WHEN {side}Player2 IS NOT NULL THEN 1 ELSE 0 END + 
-        CASE WHEN {side}Player3 IS NOT NULL THEN 1 ELSE 0 END + 
-        CASE WHEN {side}Player4 IS NOT NULL THEN 1 ELSE 0 END + 
-        CASE WHEN {side}Player5 IS NOT NULL THEN 1 ELSE 0 END + 
-        CASE WHEN {side}Player6 IS NOT NULL THEN 1 ELSE 0 END + 
-        CASE WHEN {side}Player7 IS NOT NULL THEN 1 ELSE 0 END + 
-        CASE WHEN {side}Player8 IS NOT NULL THEN 1 ELSE 0 END + 
-        CASE WHEN {side}Player9 IS NOT NULL THEN 1 ELSE 0 END
-        )
-        """
-        
-        # Execute the query
-        cursor.execute(mp_query)
-        #print("Manpower", side, "done!")
+    # Add the primary key after the data has been inserted so that the index
+    # is built in a single sort.
+    key_query = f"ALTER TABLE {pbp_table} ADD PRIMARY KEY(GameId, EventNumber)"
+    cursor.execute(key_query)
     
     # Commit all changes
     connection.commit()
@@ -186,8 +171,7 @@ def add_manpower(connection, pbp_table="mpbp"):
 def add_gf_and_ga_fast(connection, pbp_table="mpbp"):
     """
     Add goals for and against from the home team perspective for each game.
-    Note: As per the MySQL documentation, this method of solving it will be 
-    deprecated in the future (Version 9.0 and later). 
+    Note: Requires window functions, i.e. MySQL 8.0 or later.
         
     Author: Rasmus Säfvenberg
 
@@ -210,93 +194,62 @@ def add_gf_and_ga_fast(connection, pbp_table="mpbp"):
     # Create a cursor to executy queries
     cursor = connection.cursor(buffered=True)
 
-    # Ensure we recreate the table if it already exists
-    drop_query = """DROP TABLE IF EXISTS mPBP_temp"""
+    # Ensure we recreate the tables if they already exist
+    drop_query = f"""DROP TABLE IF EXISTS {pbp_table}_temp, {pbp_table}_old"""
     cursor.execute(drop_query)
 
-    # Create a temporary table MySQL doesn't update with local variables.
-    query = f"""CREATE TABLE mpbp_temp
-            SELECT *
-            FROM
-            (SELECT rowTable.GameId, rowTable.AwayTeamId, rowTable.HomeTeamId,
-            rowTable.ActionSequence, rowTable.EventNumber, rowTable.PeriodNumber,
-            rowTable.EventTime, rowTable.EventType, rowTable.ScoringTeamId, 
-            rowTable.ExternalEventId, rowTable.Outcome, rowTable.OutcomeAway, 
-            rowTable.AwayPlayer1, rowTable.AwayPlayer2, rowTable.AwayPlayer3, 
-            rowTable.AwayPlayer4, rowTable.AwayPlayer5, rowTable.AwayPlayer6,
-            rowTable.AwayPlayer7, rowTable.AwayPlayer8, rowTable.AwayPlayer9,
-            rowTable.HomePlayer1, rowTable.HomePlayer2, rowTable.HomePlayer3, 
-            rowTable.HomePlayer4, rowTable.HomePlayer5, rowTable.HomePlayer6,
-            rowTable.HomePlayer7, rowTable.HomePlayer8, rowTable.HomePlayer9,
-            rowTable.Date, rowTable.TimeBin, 
-            rowTable.AwayTeamScore as GoalsAgainst,
-            rowTable.HomeTeamScore as GoalsFor,
-            rowTable.GoalDiff, rowTable.GoalDiffAway, 
-            rowTable.ManpowerAway, rowTable.ManpowerHome,
-            rowTable.ManpowerDiff, rowTable.ManpowerDiffAway
-            FROM
-            (SELECT 
-                g.*,
-                @curr_game := g.GameId AS CurrGameId,
-                @curr_goal := g.ScoringTeamId AS CurrScoringTeamId,
-                @curr_home := g.HomeTeamId AS HomeTeamIdCurr,
-                @curr_away := g.AwayTeamId AS AwayTeamIdCurr,#
-                @home_team_score := IF(@curr_game != @prev_game, 
-                      IF(@curr_home = @curr_goal AND @prev_game = g.GameId, 
-                            @home_team_score + 1, IF(@curr_home = @curr_goal, 1, 0)),
-                      IF(@prev_home = @curr_goal, @home_team_score + 1, @home_team_score)
-                                ) AS HomeTeamScore,
-                @away_team_score := IF(@curr_game != @prev_game, 
-                      IF(@curr_away = @curr_goal AND @prev_game = g.GameId, 
-                            @away_team_score + 1, IF(@curr_away = @curr_goal, 1, 0)),
-                      IF(@prev_away = @curr_goal, @away_team_score + 1, @away_team_score)
-                                ) AS AwayTeamScore,
-                @prev_home := g.HomeTeamId AS PrevHomeTeamId,
-                @prev_away := g.AwayTeamId AS PrevAwayTeamId,
-                @prev_game := g.GameId AS PrevGameId
-            FROM {pbp_table} g,
-            (SELECT @home_team_score := 0) hscore,
-            (SELECT @away_team_score := 0) ascore,
-            (SELECT @curr_goal := '') cgoal,
-            (SELECT @prev_game := 0) pgame,
-            (SELECT @curr_game := 0) cgame,
-            (SELECT @prev_home := '') phome,
-            (SELECT @prev_away = '') paway,
-            (SELECT @curr_home = '') chome,
-            (SELECT @curr_away = '') caway) as rowTable) as results;"""
-
+    # Create a temporary table with the same columns and keys as the original
+    query = f"CREATE TABLE {pbp_table}_temp LIKE {pbp_table};"
     cursor.execute(query)
 
-    # Remove original table data
-    query = f"DELETE FROM {pbp_table};"
+    # Fill the temporary table with the running score of each game. The frame
+    # ends at the previous event since goals count after the face-off.
+    query = f"""INSERT INTO {pbp_table}_temp
+            (GameId, AwayTeamId, HomeTeamId,
+            ActionSequence, EventNumber, PeriodNumber,
+            EventTime, EventType, ScoringTeamId, 
+            ExternalEventId, Outcome, OutcomeAway, 
+            AwayPlayer1, AwayPlayer2, AwayPlayer3, 
+            AwayPlayer4, AwayPlayer5, AwayPlayer6,
+            AwayPlayer7, AwayPlayer8, AwayPlayer9,
+            HomePlayer1, HomePlayer2, HomePlayer3, 
+            HomePlayer4, HomePlayer5, HomePlayer6,
+            HomePlayer7, HomePlayer8, HomePlayer9,
+            Date, TimeBin, GoalsAgainst, GoalsFor,
+            GoalDiff, GoalDiffAway)
+            SELECT g.GameId, g.AwayTeamId, g.HomeTeamId,
+            g.ActionSequence, g.EventNumber, g.PeriodNumber,
+            g.EventTime, g.EventType, g.ScoringTeamId, 
+            g.ExternalEventId, g.Outcome, g.OutcomeAway, 
+            g.AwayPlayer1, g.AwayPlayer2, g.AwayPlayer3, 
+            g.AwayPlayer4, g.AwayPlayer5, g.AwayPlayer6,
+            g.AwayPlayer7, g.AwayPlayer8, g.AwayPlayer9,
+            g.HomePlayer1, g.HomePlayer2, g.HomePlayer3, 
+            g.HomePlayer4, g.HomePlayer5, g.HomePlayer6,
+            g.HomePlayer7, g.HomePlayer8, g.HomePlayer9,
+            g.Date, g.TimeBin, 
+            COALESCE(SUM(CASE WHEN g.ScoringTeamId = g.AwayTeamId THEN 1 ELSE 0 END)
+                OVER (w ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0),
+            COALESCE(SUM(CASE WHEN g.ScoringTeamId = g.HomeTeamId THEN 1 ELSE 0 END)
+                OVER (w ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0),
+            g.GoalDiff, g.GoalDiffAway
+            FROM {pbp_table} g
+            WINDOW w AS (PARTITION BY g.GameId ORDER BY g.EventNumber);"""
     cursor.execute(query)
 
-    # Recreate original table with new column added
-    query = f"""
-    INSERT INTO {pbp_table}
-    SELECT *
-    FROM mpbp_temp;"""
+    # Swap the tables atomically instead of copying the rows back
+    query = f"""RENAME TABLE {pbp_table} TO {pbp_table}_old, 
+                {pbp_table}_temp TO {pbp_table};"""
     cursor.execute(query)
 
-    # Drop temporary table
-    drop_query = "DROP TABLE mpbp_temp;"
+    # Drop the original table
+    drop_query = f"DROP TABLE {pbp_table}_old;"
     cursor.execute(drop_query)
 
-    # Remove goals at the actual goal event as they count after the face-off.
-    query = f"""UPDATE {pbp_table}
-    SET GoalsFor = GoalsFor - 1
-    WHERE EventType = "GOAL" AND ScoringTeamId = HomeTeamId;"""
-    cursor.execute(query)
-
-    query = f"""UPDATE {pbp_table}
-    SET GoalsAgainst = GoalsAgainst - 1
-    WHERE EventType = "GOAL" AND ScoringTeamId = AwayTeamId;"""
-    cursor.execute(query)
-
     connection.commit()
     
     
-def remove_shootout_goals(connection, pbp_table="mpbp"):
+def remove_shootout_goals(connection, pbp_table="mpbp", commit=True):
     """
     Remove goals scored in a shoot-out, i.e. shots & goals during period 5.
     
@@ -310,6 +263,9 @@ def remove_shootout_goals(connection, pbp_table="mpbp"):
     pbp_table : string.
         Name of the play by play SQL table to be altered. 
         The default is "mpbp".
+    commit : boolean
+        Whether to commit the changes. Set to False to group the changes
+        with subsequent queries in the same transaction. The default is True.
 
     Returns
     -------
@@ -326,10 +282,11 @@ def remove_shootout_goals(connection, pbp_table="mpbp"):
     
     # Execute query and commit changes.
     cursor.execute(query)
-    connection.commit()
+    if commit:
+        connection.commit()
     
 
-def add_outcome_to_pbp_fast(connection, engine, pbp_table="mpbp"):
+def add_outcome_to_pbp_fast(connection, pbp_table="mpbp", commit=True):
     """
     Adds a column to the play by play table with the outcome of each game from
     both the perspective of the home and away team by calculating the goals
@@ -341,103 +298,64 @@ def add_outcome_to_pbp_fast(connection, engine, pbp_table="mpbp"):
     ----------
     connection : MySQLconnection as created by db.connect_to_db
         a connection to the SQL database we are working with.
-    engine : sqlalchemy enginge as creadted by db.create_db_engine
-        an engine object such that we can use pd.to_sql() function.
     pbp_table : string.
         Name of the play by play SQL table to be altered. 
         The default is "mpbp".
+    commit : boolean
+        Whether to commit the changes. Set to False to group the changes
+        with subsequent queries in the same transaction. The default is True.
 
     Returns
     -------
     None. The related changes are instead pushed to the SQL database.
 
     """
-    # Get all play by play data
-    df_pbp = pd.read_sql(f"SELECT * FROM {pbp_table}", connection)
-   
-    # Get the final event of the game
-    game_end = df_pbp[df_pbp["EventType"].isin(["PERIOD END", "GAME END"])].\
-        drop_duplicates("GameId", keep="last").copy()
-    #df_pbp[df_pbp["EventType"] == "GAME END"].copy()
-    # Above is uncommented since some games have GAME END before PERIOD END
-    
-    # Specify the outcome for home team at the end of the game
-    game_end["Outcome"] = np.select(
-        [
-            (game_end["GoalsFor"] > game_end["GoalsAgainst"]) & (game_end["PeriodNumber"] <= 3), 
-            (game_end["GoalsFor"] < game_end["GoalsAgainst"]) & (game_end["PeriodNumber"] <= 3), 
-            (game_end["GoalsFor"] > game_end["GoalsAgainst"]) & (game_end["PeriodNumber"] > 3), 
-            (game_end["GoalsFor"] < game_end["GoalsAgainst"]) & (game_end["PeriodNumber"] > 3), 
-        ], 
-        [
-            "win", 
-            "loss",
-            "tie-win",
-            "tie-loss"
-        ], 
-        default='Unknown'
-    )
-
-    # Reverse the outcome for the away team
-    game_end["OutcomeAway"] = game_end["Outcome"].replace({'^win': 'loss', 
-                                                           '^loss': 'win',
-                                                           'tie-win': 'tie-loss', 
-                                                           'tie-loss': 'tie-win'}, 
-                                regex=True)
-
-    # Combine the correct two dataframes
-    df_pbp = df_pbp.merge(game_end[["GameId", "Outcome", "OutcomeAway"]], 
-                          on = "GameId")
-
-    # Replace NULL columns with actual values
-    df_pbp["Outcome_x"] = df_pbp["Outcome_y"]
-    df_pbp["OutcomeAway_x"] = df_pbp["OutcomeAway_y"]
-    
-    # Drop redundant columns
-    df_pbp.drop(["Outcome_y", "OutcomeAway_y"], inplace=True, axis=1)
-    
-    # Rename columns to match rest of code
-    df_pbp.rename(columns={"Outcome_x": "Outcome", 
-                           "OutcomeAway_x": "OutcomeAway"}, 
-                  inplace=True)
-    
-    # Convert from timedelta
-    df_pbp["EventTime"] = df_pbp["EventTime"].astype(str)
-    
-    # Keep only unique values
-    df_pbp.drop_duplicates("GameId", inplace=True)
-    
-    # Create temporary table     
-    df_pbp[["GameId", "Outcome", "OutcomeAway"]].to_sql("temp_table", engine, 
-                                                        if_exists='replace', 
-                                                        chunksize=10000,
-                                                        index=False)
     # Create a cursor to executy queries
     cursor = connection.cursor(buffered=True)
-    connection.commit()
     
-    # Join the original and temporary table
+    # Get the final event of the game, i.e. the last PERIOD END or GAME END 
+    # since some games have GAME END before PERIOD END. Specify the outcome 
+    # for both the home and away team at the end of the game and join it 
+    # with the original table.
     query = f"""
-    UPDATE {pbp_table} m, temp_table t 
-    SET m.Outcome = t.Outcome, m.OutcomeAway = t.OutcomeAway
-    WHERE m.GameId = t.GameId;
+    UPDATE {pbp_table} m
+    INNER JOIN 
+    (SELECT GameId,
+        CASE 
+            WHEN GoalsFor > GoalsAgainst AND PeriodNumber <= 3 THEN 'win'
+            WHEN GoalsFor < GoalsAgainst AND PeriodNumber <= 3 THEN 'loss'
+            WHEN GoalsFor > GoalsAgainst AND PeriodNumber > 3 THEN 'tie-win'
+            WHEN GoalsFor < GoalsAgainst AND PeriodNumber > 3 THEN 'tie-loss'
+            ELSE 'Unknown'
+        END AS Outcome,
+        CASE 
+            WHEN GoalsFor > GoalsAgainst AND PeriodNumber <= 3 THEN 'loss'
+            WHEN GoalsFor < GoalsAgainst AND PeriodNumber <= 3 THEN 'win'
+            WHEN GoalsFor > GoalsAgainst AND PeriodNumber > 3 THEN 'tie-loss'
+            WHEN GoalsFor < GoalsAgainst AND PeriodNumber > 3 THEN 'tie-win'
+            ELSE 'Unknown'
+        END AS OutcomeAway
+    FROM
+        (SELECT GameId, PeriodNumber, GoalsFor, GoalsAgainst,
+            ROW_NUMBER() OVER (PARTITION BY GameId 
+                               ORDER BY EventNumber DESC) AS EventRank
+        FROM {pbp_table}
+        WHERE EventType IN ('PERIOD END', 'GAME END')) game_end
+    WHERE EventRank = 1) t 
+    ON m.GameId = t.GameId
+    SET m.Outcome = t.Outcome, m.OutcomeAway = t.OutcomeAway;
     """
     
-    # Execute query
+    # Execute query and commit changes.
     cursor.execute(query)
-    
-    # Drop temporary table
-    drop_query = "DROP TABLE temp_table;"
-    cursor.execute(drop_query)
-    
-    # Commit all changes.
-    connection.commit()
+    if commit:
+        connection.commit()
 
 
-def add_goal_mp_differential(connection, pbp_table="mpbp"):
+def add_scoring_team_id(connection, pbp_table="mpbp", commit=True):
     """
-    Add new columns to the play by play table with Goal & Manpower difference 
-    from both the home and away team perspective.     
+    Add team id of the scoring team to the play by play table in order to 
+    easier to identify scoring team and whether home or away team scored.
     
     Author: Jon Vik
     Updates by: Rasmus Säfvenberg
@@ -447,7 +365,11 @@ def add_goal_mp_differential(connection, pbp_table="mpbp"):
     connection : MySQLconnection as created by db.connect_to_db
         a connection to the SQL database we are working with.
     pbp_table : string.
-        Name of the play by play SQL table to be altered. The default is "mpbp".
+        Name of the play by play SQL table to be altered. 
+        The default is "mpbp".
+    commit : boolean
+        Whether to commit the changes. Set to False to group the changes
+        with subsequent queries in the same transaction. The default is True.
 
     Returns
     -------
@@ -457,22 +379,27 @@ def add_goal_mp_differential(connection, pbp_table="mpbp"):
     # Create a cursor to executy queries
     cursor = connection.cursor(buffered=True)
     
-    # Calculate the differences for goals and manpower for each team.
-    diff_query = f"""UPDATE {pbp_table} 
-    SET ManpowerDiff = (ManpowerHome - ManpowerAway),  
-    GoalDiff = (GoalsFor - GoalsAgainst),
-    ManpowerDiffAway = (ManpowerAway - ManpowerHome),  
-    GoalDiffAway = (GoalsAgainst - GoalsFor)"""
+    # Update the SQL table with ScoringTeamId column from event_goal table.
+    query = f"""
+        UPDATE {pbp_table} p
+        INNER JOIN event_goal g
+        ON p.GameId = g.GameId AND p.EventNumber = g.EventNumber
+        SET p.ScoringTeamId = g.ScoringTeamId
+        """
     
     # Execute the query and commit changes
-    cursor.execute(diff_query)
-    connection.commit()
+    cursor.execute(query)
+    if commit:
+        connection.commit()
 
 
-def add_scoring_team_id(connection, drop_column=False, pbp_table="mpbp"):
+def add_game_state_fields(connection, pbp_table="mpbp", commit=True):
     """
-    Add team id of the scoring team to the play by play table in order to 
-    easier to identify scoring team and whether home or away team scored.
+    Add goal difference from both the home and away team perspective and 
+    total elapsed time during the match to the SQL table. Both fields are 
+    calculated in a single pass over the table.
+    Total elapsed time is 0-1200 for period 1, 1201-2400 for period 2, 
+    2401-3600 for period 3 and so on.
     
     Author: Jon Vik
     Updates by: Rasmus Säfvenberg
@@ -481,12 +408,12 @@ def add_scoring_team_id(connection, drop_column=False, pbp_table="mpbp"):
     ----------
     connection : MySQLconnection as created by db.connect_to_db
         a connection to the SQL database we are working with.
-    drop_column : boolean
-        Whether to drop the scoring team id column from the SQL table. 
-        The default is False.
     pbp_table : string.
         Name of the play by play SQL table to be altered. 
         The default is "mpbp".
+    commit : boolean
+        Whether to commit the changes. Set to False to group the changes
+        with subsequent queries in the same transaction. The default is True.
 
     Returns
     -------
@@ -495,34 +422,30 @@ def add_scoring_team_id(connection, drop_column=False, pbp_table="mpbp"):
     """
     # Create a cursor to executy queries
     cursor = connection.cursor(buffered=True)
-    
-    # If the column already exists we should drop it
-    if drop_column:
-        query = f"ALTER TABLE {pbp_table} DROP COLUMN ScoringTeamId"
-        cursor.execute(query)
-
-    # Add the column scoring team id to the table
-    query = f"ALTER TABLE {pbp_table} ADD COLUMN ScoringTeamId INT AFTER EventType"
-    cursor.execute(query)
 
-    # Update the SQL table with ScoringTeamId column from event_goal table.
+    # Calculate the differences for goals for each team and the total elapsed
+    # time during the match.
     query = f"""
-        UPDATE {pbp_table} p
-        INNER JOIN event_goal g
-        ON p.GameId = g.GameId AND p.EventNumber = g.EventNumber
-        SET p.ScoringTeamId = g.ScoringTeamId
+        UPDATE {pbp_table} 
+        SET GoalDiff = (GoalsFor - GoalsAgainst),
+        GoalDiffAway = (GoalsAgainst - GoalsFor),
+        TotalElapsedTime = Time_to_sec(EventTime) + (1200 * (PeriodNumber - 1))
         """
-    
+       
     # Execute the query and commit changes
     cursor.execute(query)
-    connection.commit()
+    if commit:
+        connection.commit()
 
 
-def add_total_elapsed_time(connection, drop_column=False, pbp_table="mpbp"):
+def create_reward_indexes(connection):
     """
-    Add total elapsed time during the match as a column to the SQL table.
-    Total elapsed time is 0-1200 for period 1, 1201-2400 for period 2, 
-    2401-3600 for period 3 and so on.
+    Create the indexes on the static tables joined with the occurrences in
+    reward.apply_reward, unless they already exist. The total elapsed time 
+    of each goal is added to event_goal as a stored column, such that the 
+    goals can be looked up by index. As this changes the schema of the 
+    source tables event_goal and player, it is run once when setting up the 
+    database rather than as part of the weighted reward runs.
     
     Author: Rasmus Säfvenberg
 
@@ -530,12 +453,6 @@ def add_total_elapsed_time(connection, drop_column=False, pbp_table="mpbp"):
     ----------
     connection : MySQLconnection as created by db.connect_to_db
         a connection to the SQL database we are working with.
-    drop_column : boolean
-        Whether to drop the scoring team id column from the SQL table. 
-        The default is False.
-    pbp_table : string.
-        Name of the play by play SQL table to be altered. 
-        The default is "mpbp".
 
     Returns
     -------
@@ -544,32 +461,114 @@ def add_total_elapsed_time(connection, drop_column=False, pbp_table="mpbp"):
     """
     # Create a cursor to executy queries
     cursor = connection.cursor(buffered=True)
-
-    # If the column already exists we should drop it
-    if drop_column:
-        query = f"ALTER TABLE {pbp_table} DROP COLUMN TotalElapsedTime"
+    
+    # Check if the total elapsed time has already been added to event_goal
+    cursor.execute("""SELECT COUNT(*) FROM information_schema.columns
+                      WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'event_goal'
+                      AND COLUMN_NAME = 'TotalElapsedTime'""")
+    
+    if cursor.fetchone()[0] == 0:
+        # Total elapsed time of the goals, calculated once when stored
+        query = """ALTER TABLE event_goal 
+                   ADD COLUMN TotalElapsedTime INT AS 
+                   ((PeriodNumber - 1) * 20 * 60 + TIME_TO_SEC(EventTime)) STORED"""
         cursor.execute(query)
+    
+    # The indexes used to join the goals and the goal scorers
+    indexes = {"ix_eg_gtet": ("event_goal", "GameId, TotalElapsedTime"),
+               "ix_player_id_pos": ("player", "PlayerId, Position")}
+    
+    # Names of the indexes that already exist
+    cursor.execute("""SELECT DISTINCT INDEX_NAME FROM information_schema.statistics
+                      WHERE TABLE_SCHEMA = DATABASE() 
+                      AND TABLE_NAME IN ('event_goal', 'player')""")
+    existing_indexes = {index_name for (index_name, ) in cursor.fetchall()}
+    
+    # Create the missing indexes
+    for index_name, (table, columns) in indexes.items():
+        if index_name not in existing_indexes:
+            cursor.execute(f"CREATE INDEX {index_name} ON {table}({columns})")
 
-    # If using seconds
-    query = f"ALTER TABLE {pbp_table} ADD COLUMN TotalElapsedTime int AFTER EventTime"
-    cursor.execute(query)
 
-    # Calculate total elapsed time during the match
-    query = f"""
-       UPDATE {pbp_table} 
-       SET TotalElapsedTime = Time_to_sec(EventTime) + (1200 * (PeriodNumber - 1))
-       """
-       
-    # Execute the query and commit changes
-    cursor.execute(query)
+def populate_fields(connection, season=None, start_date=None, end_date=None, 
+                    multiple_parts=False, playoffs=False,
+                    evaluation_season=None, start_date_evaluation=None,
+                    pbp_table="mpbp"):
+    """
+    Cut the play by play data and populate all fields of a single play by 
+    play table.
+    
+    Author: Rasmus Säfvenberg
+
+    Parameters
+    ----------
+    connection : MySQLconnection as created by db.connect_to_db
+        a connection to the SQL database we are working with. If None, a 
+        new connection is created, e.g. when run in a separate process.
+    season : integer value of 4 characters (e.g. 2013)
+        Selects games from the given season.
+        Valid inputs are 2007 - 2014.
+    start_date : integer value of format yyyymmdd
+        The start date we are interested in examining.
+    end_date : integer value of format yyyymmdd
+        The end date we are interested in examining.
+    multiple_parts : boolean
+        Whether to consider multiple parts (seasons/partitions) worth of data.
+        The default is False.
+    playoffs : boolean
+        To consider only playoffs or regular season.
+        The default is False.
+    evaluation_season : integer value of 4 characters (e.g. 2013)
+        The season to evaluate the data specified in season on.
+        The default is None.
+    start_date_evaluation : integer value of format yyyymmdd
+        The date to start the valiation set at. Will be between
+        start_date_evaluation and end_date.
+    pbp_table : string.
+        Name of the play by play SQL table to be created. 
+        The default is "mpbp".
+
+    Returns
+    -------
+    None. The related changes are instead pushed to the SQL database.
+
+    """
+    # MySQL connections can not be shared between processes
+    if connection is None:
+        connection = connect_to_db("hockey")
+        
+    # Cut all data into smaller parts
+    cut_play_by_play(connection, season, start_date, end_date, multiple_parts,
+                     playoffs, evaluation_season, start_date_evaluation,
+                     pbp_table=pbp_table)
+    
+    # Add the id of the scoring team. Committed implicitly by the DDL 
+    # statements of the next step.
+    add_scoring_team_id(connection, pbp_table=pbp_table, commit=False)
+    
+    # Add goals for and against
+    add_gf_and_ga_fast(connection, pbp_table=pbp_table)
+    
+    # The remaining steps only modify data and are committed together
+    # Remove shootout goals
+    remove_shootout_goals(connection, pbp_table=pbp_table, commit=False)
+    
+    # Add outcomes to the play-by-play table
+    add_outcome_to_pbp_fast(connection, pbp_table=pbp_table, commit=False)
+    
+    # Add goal differences and the total elapsed time in-game
+    add_game_state_fields(connection, pbp_table=pbp_table, commit=False)
+    
+    # Commit all changes
     connection.commit()
+    print("Fields have been populated!")
 
 
 def extract_season(connection, engine, season=None, 
                    start_date=None, end_date=None, 
                    multiple_parts=False, playoffs=False, 
                    evaluation_season=None, start_date_evaluation=None, 
-                   pbp_table="mpbp"):
+                   pbp_table="mpbp", n_jobs=1):
     """
     Extract the season and all required data for the given season.
     
@@ -581,7 +580,7 @@ def extract_season(connection, engine, season=None,
     connection : MySQLconnection as created by db.connect_to_db
         a connection to the SQL database we are working with.
     engine : sqlalchemy enginge as creadted by db.create_db_engine
-        an engine object such that we can use pd.to_sql() function.
+        an engine object. Kept for compatibility with existing callers.
     season : integer value of 4 characters (e.g. 2013)
         Selects games from the given season.
         Valid inputs are 2007 - 2014.
@@ -604,6 +603,10 @@ def extract_season(connection, engine, season=None,
     pbp_table : string.
         Name of the play by play SQL table to be used. 
         The default is "mpbp".
+    n_jobs : integer, default is 1
+        The number of processes used to populate the play by play tables. 
+        If 2 and evaluated, the training and evaluation tables are populated 
+        in parallel, each process with its own connection.
         
     Returns
     -------
@@ -626,6 +629,9 @@ def extract_season(connection, engine, season=None,
     if evaluation_season is not None:
         multiple_season = True
         
+    # Arguments for each table to create
+    table_args = []
+    
     # "Loop" over the amount of tables to create; 2 if to be evaluated
     for table_count in range(n_tables):
         if table_count == 1:
@@ -646,38 +652,30 @@ def extract_season(connection, engine, season=None,
                 else: 
                     start_date_evaluation = start_date
                 
-        # Cut all data into smaller parts
-        cut_play_by_play(connection, season, start_date, end_date, multiple_parts,
-                         playoffs, evaluation_season, start_date_evaluation,
-                         pbp_table=pbp_table)
-        
-        # Add the id of the scoring team
-        add_scoring_team_id(connection, pbp_table=pbp_table)
-        
-        # Add manpower values
-        add_manpower(connection, pbp_table=pbp_table)
-        
-        # Add goals for and against
-        add_gf_and_ga_fast(connection, pbp_table=pbp_table)
-        
-        # Remove shootout goals
-        remove_shootout_goals(connection, pbp_table=pbp_table)
+        # Arguments for populating the fields of the current table
+        table_args.append((season, start_date, end_date, multiple_parts,
+                           playoffs, evaluation_season, start_date_evaluation,
+                           pbp_table))
         
-        # Add outcomes to the play-by-play table
-        add_outcome_to_pbp_fast(connection, engine, pbp_table=pbp_table)
-        
-        # Add goal and manpower differences
-        add_goal_mp_differential(connection, pbp_table=pbp_table)
-        
-        # Add the total elapsed time in-game
-        add_total_elapsed_time(connection, pbp_table=pbp_table)
-        print("Fields have been populated!")
+    # The tables can only be populated in parallel if they are different
+    table_names = [args[-1] for args in table_args]
+    if n_jobs > 1 and len(set(table_names)) > 1:
+        # Populate the tables in separate processes with their own connections
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(populate_fields, [None] * len(table_args), 
+                              *zip(*table_args)))
+    else:
+        for args in table_args:
+            populate_fields(connection, *args)
 
 
 if __name__ == "__main__":
     connection = connect_to_db("hockey")
     engine = create_db_engine("hockey")
     
+    # One-time setup of the goal times and indexes used to calculate the reward
+    create_reward_indexes(connection)
+    
     # # Check one full season
     season = 2012
     # extract_season(connection, engine, season, 
@@ -2,12 +2,22 @@
 # -*- coding: utf-8 -*-
 
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from db import connect_to_db, create_db_engine
 import numpy as np
+from numba import njit
+
+# Specify the amount of players in database for each team
+HOMEPLAYERS = ['HomePlayer{}'.format(n) for n in range(1, 10)]
+AWAYPLAYERS = ['AwayPlayer{}'.format(n) for n in range(1, 10)]
+
+# Specify strings to make the query more readable
+HOMEPLAYERS_SQL = ', '.join(HOMEPLAYERS)
+AWAYPLAYERS_SQL = ', '.join(AWAYPLAYERS)
 
 
 def get_data(connection, season=None, multiple_parts=False, 
-             pbp_table="mpbp", reward_table="reward"):
+             pbp_table="mpbp", reward_table="reward", chunksize=50000):
     """
     Extract the needed data from the pbp, event_goal and reward tables.
 
@@ -30,6 +40,9 @@ def get_data(connection, season=None, multiple_parts=False,
     reward_table : string.
         Name of the reward SQL table to be used. 
         The default is "reward"
+    chunksize : integer
+        Number of rows to read from the database at a time.
+        The default is 50000.
         
     Returns
     -------
@@ -39,20 +52,12 @@ def get_data(connection, season=None, multiple_parts=False,
 
     """
         
-    # Specify the amount of players in database for each team
-    HOMEPLAYERS = ['HomePlayer{}'.format(n) for n in range(1, 10)]
-    AWAYPLAYERS = ['AwayPlayer{}'.format(n) for n in range(1, 10)]
-    
-    # Specify strings to make the query more readable
-    home_string = ', '.join(HOMEPLAYERS)
-    away_string = ', '.join(AWAYPLAYERS)
-    
     # Retrieve the needed data to group rewards
     query = f"""
     SELECT pbp.GameId, pbp.AwayTeamId, pbp.HomeTeamId, pbp.EventNumber, pbp.PeriodNumber, 
            r.TotalElapsedTime, r.GD, r.MD, 
            g.ScoringTeam, g.ScoringTeamId, g.Disposition, g.GoalScorerId, 
-           r.reward, g.FirstAssistId, g.SecondAssistId, {away_string}, {home_string},
+           r.reward, g.FirstAssistId, g.SecondAssistId, {AWAYPLAYERS_SQL}, {HOMEPLAYERS_SQL},
            win_before, loss_before, `tie-win_before`, `tie-loss_before`,
            win_after, loss_after, `tie-win_after`, `tie-loss_after`
     FROM {pbp_table} pbp, event_goal g, {reward_table} r
@@ -61,16 +66,89 @@ def get_data(connection, season=None, multiple_parts=False,
           AND pbp.ExternalEventId = g.GoalId
           AND pbp.TotalElapsedTime = r.TotalElapsedTime"""
     
-    # Read data as data frame
-    df = pd.read_sql(query, con=connection)
-    
-    # Convert columns to desired format
-    df[HOMEPLAYERS] = df[HOMEPLAYERS].astype('Int64')
-    df[AWAYPLAYERS] = df[AWAYPLAYERS].astype('Int64')
+    # Read data as data frame in chunks, converting the player columns 
+    # to the desired format (player ids fit in 32 bits) one chunk at a time
+    # so the full result is never held with float64 player columns
+    chunks = []
+    for chunk in pd.read_sql(query, con=connection, chunksize=chunksize):
+        chunk[HOMEPLAYERS] = chunk[HOMEPLAYERS].astype('Int32')
+        chunk[AWAYPLAYERS] = chunk[AWAYPLAYERS].astype('Int32')
+        chunks.append(chunk)
+    
+    # Combine the chunks to a single data frame
+    if chunks:
+        df = pd.concat(chunks, ignore_index=True)
+    else:
+        # No goals were found, such that there are no chunks to combine
+        columns = ["GameId", "AwayTeamId", "HomeTeamId", "EventNumber", 
+                   "PeriodNumber", "TotalElapsedTime", "GD", "MD", 
+                   "ScoringTeam", "ScoringTeamId", "Disposition", "GoalScorerId", 
+                   "reward", "FirstAssistId", "SecondAssistId"] + \
+            AWAYPLAYERS + HOMEPLAYERS + \
+            ["win_before", "loss_before", "tie-win_before", "tie-loss_before",
+             "win_after", "loss_after", "tie-win_after", "tie-loss_after"]
+        
+        # Numeric columns, except for the player ids and the string columns
+        dtypes = dict.fromkeys(columns, np.float64)
+        dtypes.update(dict.fromkeys(HOMEPLAYERS + AWAYPLAYERS, 'Int32'))
+        dtypes.update({"ScoringTeam": object, "Disposition": object})
+        df = pd.DataFrame(columns=columns).astype(dtypes)
     
     return df
 
 
+@njit(cache=True)
+def sum_plus_minus(home_ids, away_ids, pm_home, home_reward, n_ids):
+    """
+    Sum the plus-minus and weighted plus-minus per player for the players
+    on the ice. Compiled with numba such that the player ids are read in a 
+    single pass.
+
+    Parameters
+    ----------
+    home_ids : np.ndarray
+        2D array of the home player codes (0, ..., n_ids - 1) per goal, 
+        with -1 for empty slots.
+    away_ids : np.ndarray
+        2D array of the away player codes (0, ..., n_ids - 1) per goal, 
+        with -1 for empty slots.
+    pm_home : np.ndarray
+        The plus-minus per goal from the home team perspective.
+    home_reward : np.ndarray
+        The signed reward per goal from the home team perspective.
+    n_ids : integer
+        The number of players, i.e. distinct player codes.
+
+    Returns
+    -------
+    n_goals : np.ndarray
+        The number of goals each player has been on the ice for.
+    plus_minus : np.ndarray
+        The plus-minus per player.
+    reward : np.ndarray
+        The weighted plus-minus per player.
+
+    """
+    n_goals = np.zeros(n_ids, dtype=np.int64)
+    plus_minus = np.zeros(n_ids, dtype=np.int64)
+    reward = np.zeros(n_ids, dtype=np.float64)
+    for i in range(home_ids.shape[0]):
+        for j in range(home_ids.shape[1]):
+            # The away team gets the opposite plus-minus and reward
+            player_id = home_ids[i, j]
+            if player_id >= 0:
+                n_goals[player_id] += 1
+                plus_minus[player_id] += pm_home[i]
+                reward[player_id] += home_reward[i]
+            player_id = away_ids[i, j]
+            if player_id >= 0:
+                n_goals[player_id] += 1
+                plus_minus[player_id] -= pm_home[i]
+                reward[player_id] -= home_reward[i]
+    
+    return n_goals, plus_minus, reward
+
+
 def calc_plus_minus(data):
     """
     Calculate the total traditional and weighted plus-minus statistic for all
@@ -88,97 +166,50 @@ def calc_plus_minus(data):
 
     """
 
-    df = data.copy()
-    # Specify the amount of players in database for each team
-    HOMEPLAYERS = ['HomePlayer{}'.format(n) for n in range(1, 10)]
-    AWAYPLAYERS = ['AwayPlayer{}'.format(n) for n in range(1, 10)]
-    
-    # Calculate plus-minus from the away team perspective
-    df["PlusMinusAway"] = np.select(
-        [
-             # Traditional
-            (df["ScoringTeamId"] != df["HomeTeamId"]) & (df["MD"] >= 0), 
-            (df["ScoringTeamId"] != df["HomeTeamId"]) & (df["MD"] < 0), 
-            (df["ScoringTeamId"] == df["HomeTeamId"]) & (df["MD"] > 0), 
-            (df["ScoringTeamId"] == df["HomeTeamId"]) & (df["MD"] <= 0), 
-        ], 
-        [
-            1, 
-            0, 
-            0, 
-            -1,
-        ], 
-        default=999
-    )
-
-    # Calculate plus-minus from the home team perspective
-    df["PlusMinusHome"] = np.select(
-        [     
-             # Traditional
-            (df["ScoringTeamId"] == df["HomeTeamId"]) & (df["MD"] <= 0), 
-            (df["ScoringTeamId"] == df["HomeTeamId"]) & (df["MD"] > 0), 
-            (df["ScoringTeamId"] != df["HomeTeamId"]) & (df["MD"] < 0), 
-            (df["ScoringTeamId"] != df["HomeTeamId"]) & (df["MD"] >= 0), 
-        ], 
-        [
-            1, 
-            0, 
-            0, 
-            -1,
-        ], 
-        default=999
-    )
-
-    
     # Indicator variable for whether the home team scored
-    df["ScoringTeam"] = np.where(df["ScoringTeamId"] == df["HomeTeamId"], "Home", "Away")
-
-    # Get players for both team and plusminus values
-    plusminus = pd.concat([df[HOMEPLAYERS+AWAYPLAYERS], 
-                           df[["GameId", "TotalElapsedTime", 
-                               "PlusMinusHome", "PlusMinusAway", "reward",
-                               "ScoringTeam"]]], 
-                          axis=1)
-
-    # Rename the columns and convert from wide to long
-    plusminus = plusminus.rename(columns={"HomePlayer1": "Home", "HomePlayer2": "Home",
-                                          "HomePlayer3": "Home", "HomePlayer4": "Home",
-                                          "HomePlayer5": "Home", "HomePlayer6": "Home",
-                                          "HomePlayer7": "Home", "HomePlayer8": "Home",
-                                          "HomePlayer9": "Home", 
-                                          "AwayPlayer1": "Away", "AwayPlayer2": "Away",
-                                          "AwayPlayer3": "Away", "AwayPlayer4": "Away",
-                                          "AwayPlayer5": "Away", "AwayPlayer6": "Away",
-                                          "AwayPlayer7": "Away", "AwayPlayer8": "Away",
-                                          "AwayPlayer9": "Away"
-                                          }).melt(id_vars=("GameId", "TotalElapsedTime", 
-                                                           "PlusMinusHome", "PlusMinusAway",
-                                                           "reward", "ScoringTeam"),
-                                                  var_name="Side",
-                                                  value_name="PlayerId")
-    
-    # Drop NA values for PlayerId
-    plusminus = plusminus.loc[~plusminus["PlayerId"].isna()]
-                              
+    home_scored = (data["ScoringTeamId"] == data["HomeTeamId"]).to_numpy()
+    md = data["MD"].to_numpy()
+    
+    # Calculate plus-minus from the home team perspective: +1 if the home team
+    # scored while not in powerplay, -1 if the away team scored while not in 
+    # powerplay and 0 otherwise. The away team gets the opposite.
+    pm_home = (home_scored & (md <= 0)).astype(np.int8) - \
+        (~home_scored & (md >= 0)).astype(np.int8)
+    
     # Set negative reward if the opposition scored
-    plusminus.loc[plusminus["Side"] != plusminus["ScoringTeam"], "reward"] *= -1 
+    reward = data["reward"].to_numpy(dtype=np.float64)
+    home_reward = np.where(home_scored, reward, -reward)
 
     # Set reward to 0 if no plus-minus was awarded and since if one team has 0
     # plus-minus the other team also has 0 it suffices to check one side.
-    plusminus.loc[plusminus["PlusMinusHome"] == 0, "reward"] = 0 
+    home_reward[pm_home == 0] = 0
+    
+    # Missing rewards count as 0, as when summing with groupby
+    home_reward[np.isnan(home_reward)] = 0
 
-    # Calculate plus-minus while playing home and away respectively                            
-    home_pm = plusminus[plusminus["Side"] == "Home"].groupby(["PlayerId"])\
-        [["PlusMinusHome", "reward"]].sum().reset_index()\
-            .rename(columns={"PlusMinusHome": "PlusMinus"})
-            
-    away_pm = plusminus[plusminus["Side"] == "Away"].groupby(["PlayerId"])\
-        [["PlusMinusAway", "reward"]].sum().reset_index()\
-            .rename(columns={"PlusMinusAway": "PlusMinus"})
+    # Player ids on the ice for both teams, with -1 for empty slots
+    ids = data[HOMEPLAYERS + AWAYPLAYERS].to_numpy(dtype=np.int32, na_value=-1)
+    
+    # Factorize the player ids to codes 0, ..., number of players - 1, such 
+    # that the sums are not sized by the largest player id
+    player_id, codes = np.unique(ids, return_inverse=True)
+    codes = codes.reshape(ids.shape)
+    if player_id.size > 0 and player_id[0] == -1:
+        # Keep -1 for the empty slots
+        player_id = player_id[1:]
+        codes = codes - 1
+    home_ids, away_ids = codes[:, :len(HOMEPLAYERS)], codes[:, len(HOMEPLAYERS):]
+    
+    # Calculate plus-minus and weighted plus-minus per player
+    n_goals, total_plus_minus, total_reward = sum_plus_minus(home_ids, away_ids, 
+                                                             pm_home, home_reward,
+                                                             len(player_id))
 
     # Calculate total plus-minus
-    weighted_plus_minus = home_pm.append(away_pm).groupby("PlayerId").sum().\
-        reset_index().rename(columns={"reward": "WeightedPlusMinus"}).\
+    weighted_plus_minus = pd.DataFrame({
+        "PlayerId": player_id.astype(np.int64),
+        "PlusMinus": total_plus_minus,
+        "WeightedPlusMinus": total_reward}).\
             sort_values("WeightedPlusMinus", ascending=False)
     
     return weighted_plus_minus
@@ -202,18 +233,11 @@ def calc_goals(data):
         A data frame with total goals and weighted goals per player.
 
     """  
-    # Get required columns
-    goals = data[["GoalScorerId", "reward"]].copy()
-    
-    # Intialize new columns that means 1 goal per event.
-    goals["GoalsScored"] = 1
-    
     # Calculate number of goals and weighted goals per player
-    weighted_goals = goals.groupby("GoalScorerId")[["GoalsScored", "reward"]].sum().reset_index().\
-                          rename(columns={"GoalsScored": "Goals", 
-                                          "reward": "WeightedGoals", 
-                                          "GoalScorerId": "PlayerId"}).\
-                              sort_values("WeightedGoals", ascending=False)
+    weighted_goals = data.groupby("GoalScorerId")["reward"].\
+        agg(Goals="size", WeightedGoals="sum").reset_index().\
+            rename(columns={"GoalScorerId": "PlayerId"}).\
+                sort_values("WeightedGoals", ascending=False)
                               
     return weighted_goals
 
@@ -237,22 +261,29 @@ def calc_assists(data):
 
     """
     
-    # Get required columns
-    assists = data[["FirstAssistId", "SecondAssistId", "reward"]].copy()
+    # Have each assist (first/second) and its reward as one element
+    player_ids = np.concatenate([data["FirstAssistId"].to_numpy(dtype=np.float64), 
+                                 data["SecondAssistId"].to_numpy(dtype=np.float64)])
+    # Missing rewards count as 0, as when summing with groupby
+    reward = np.tile(np.nan_to_num(data["reward"].to_numpy(dtype=np.float64)), 2)
     
-    # Convert from wide to long and have each assist (first/second) as a row
-    assists = assists.rename(columns={"FirstAssistId": "AssistId", 
-                            "SecondAssistId": "AssistId"}).melt(id_vars="reward").\
-        rename(columns={"value": "PlayerId"}).drop("variable", axis=1)
+    # Drop goals without (a second) assist
+    assisted = ~np.isnan(player_ids)
+    reward = reward[assisted]
     
-    # Intialize new columns that means 1 assist per event.
-    assists["AssistedGoals"] = 1
+    # Factorize the player ids to codes 0, ..., number of players - 1, such 
+    # that the counts are not sized by the largest player id
+    player_id, codes = np.unique(player_ids[assisted].astype(np.int64), 
+                                 return_inverse=True)
     
     # Calculate number of assists and weighted assists per player
-    weighted_assists = assists.groupby("PlayerId")[["AssistedGoals", "reward"]].sum().reset_index().\
-                          rename(columns={"AssistedGoals": "Assists", 
-                                          "reward": "WeightedAssists"}).\
-                              sort_values("WeightedAssists", ascending=False)
+    weighted_assists = pd.DataFrame({
+        "PlayerId": player_id, 
+        "Assists": np.bincount(codes, minlength=len(player_id)),
+        "WeightedAssists": np.bincount(codes, weights=reward, 
+                                       minlength=len(player_id))}).\
+            sort_values("WeightedAssists", ascending=False)
+            
     return weighted_assists
   
     
@@ -275,22 +306,27 @@ def calc_first_assists(data):
 
     """
     
-    # Get required columns
-    first_assists = data[["FirstAssistId", "reward"]].copy()
+    # Have each first assist and its reward as one element
+    # (missing rewards count as 0, as when summing with groupby)
+    player_ids = data["FirstAssistId"].to_numpy(dtype=np.float64)
+    reward = np.nan_to_num(data["reward"].to_numpy(dtype=np.float64))
     
-    # Convert from wide to long and have each assist (first only) as a row
-    first_assists = first_assists.rename(columns={"FirstAssistId": "AssistId"}).\
-        melt(id_vars="reward").\
-        rename(columns={"value": "PlayerId"}).drop("variable", axis=1)
+    # Drop goals without assist
+    assisted = ~np.isnan(player_ids)
+    reward = reward[assisted]
     
-    # Intialize new columns that means 1 assist per event.
-    first_assists["AssistedGoals"] = 1
+    # Factorize the player ids to codes 0, ..., number of players - 1, such 
+    # that the counts are not sized by the largest player id
+    player_id, codes = np.unique(player_ids[assisted].astype(np.int64), 
+                                 return_inverse=True)
     
     # Calculate number of assists and weighted assists per player
-    weighted_first_assists = first_assists.groupby("PlayerId")[["AssistedGoals", "reward"]].\
-        sum().reset_index().rename(columns={"AssistedGoals": "First_Assists", 
-                                            "reward": "WeightedFirst_Assists"}).\
-                              sort_values("WeightedFirst_Assists", ascending=False)
+    weighted_first_assists = pd.DataFrame({
+        "PlayerId": player_id, 
+        "First_Assists": np.bincount(codes, minlength=len(player_id)),
+        "WeightedFirst_Assists": np.bincount(codes, weights=reward, 
+                                             minlength=len(player_id))}).\
+            sort_values("WeightedFirst_Assists", ascending=False)
                               
     return weighted_first_assists
 
@@ -339,7 +375,36 @@ def calc_points(goals, assists):
     return points
 
 
-def add_names(weighted_metric, connection):
+def get_skaters(connection):
+    """
+    Get the metadata (e.g. name and position) of all outfield players.
+
+    Author: Rasmus Säfvenberg
+
+    Parameters
+    ----------
+    connection : MySQLconnection as created by db.connect_to_db
+        a connection to the SQL database we are working with.
+
+    Returns
+    -------
+    skaters : pandas.DataFrame
+        A data frame with PlayerId, PlayerName and Position of all outfield
+        players.
+
+    """
+    # Query to obtain player metadata (e.g. name and position) of only 
+    # outfield players
+    query = """SELECT PlayerId, PlayerName, Position FROM player 
+               WHERE Position != 'G' OR Position IS NULL"""
+    
+    # Read metadata about all outfield players
+    skaters = pd.read_sql(query, connection)    
+    
+    return skaters
+
+
+def add_names(weighted_metric, connection, skaters=None):
     """
     Add player names and group the specified metric by player name.
 
@@ -350,10 +415,13 @@ def add_names(weighted_metric, connection):
     weighted_metric : pandas.DataFrame
         A data frame containing PlayerId and a specified metric, both the 
         traditional and weighted version.
-        connection : MySQLconnection as created by db.connect_to_db
-            a connection to the SQL database we are working with.
     connection : MySQLconnection as created by db.connect_to_db
         a connection to the SQL database we are working with.
+    skaters : pandas.DataFrame, optional
+        A data frame of outfield players as retrieved by 
+        weighted.get_skaters(). If None, it is read from the database.
+        The default is None.
+        
     Returns
     -------
     weighted_metric_named : pandas.DataFrame
@@ -361,15 +429,9 @@ def add_names(weighted_metric, connection):
         with player names.
 
     """
-
-    # Query to obtain player metadata (e.g. name and position)
-    query = "SELECT * FROM player"
-    
-    # Read metadata about all players
-    players = pd.read_sql(query, connection)    
-
-    # Keep only outfield players
-    skaters = players[players["Position"] != "G"]
+    # Read metadata about all outfield players
+    if skaters is None:
+        skaters = get_skaters(connection)
     
     # Add player names
     weighted_metric_named = weighted_metric.merge(skaters[["PlayerId", "PlayerName",
@@ -409,18 +471,21 @@ def add_ranks(weighted_metric, traditional_metric):
 
     """
     
-    weighted_metric_rank = weighted_metric.copy().reset_index(drop=True)
+    weighted_metric_rank = weighted_metric.reset_index(drop=True)
+    
+    # The data frame is sorted by the weighted metric
+    ranks = np.arange(1, len(weighted_metric_rank)+1)
             
     # Create a ranking according to the weighted metric
-    weighted_metric_rank["Rank_w"] = range(1, len(weighted_metric_rank)+1)
+    weighted_metric_rank["Rank_w"] = ranks
     
-    # Create a ranking according to the traditional metric (reset twice for correct value)
-    weighted_metric_rank = weighted_metric_rank.sort_values(f"{traditional_metric}", 
-                                                            ascending=False).\
-        reset_index(drop=True).reset_index().rename(columns={"index": "Rank_trad"})
-      
-    # Add 1 to index to create rank
-    weighted_metric_rank["Rank_trad"] += 1
+    # Create a ranking according to the traditional metric by the positions
+    # of the sorted traditional metric, without sorting the data frame
+    order_trad = weighted_metric_rank[f"{traditional_metric}"].\
+        sort_values(ascending=False).index.to_numpy()
+    rank_trad = np.empty_like(ranks)
+    rank_trad[order_trad] = ranks
+    weighted_metric_rank["Rank_trad"] = rank_trad
     
     # Calculate rank difference between traditional and weighted
     weighted_metric_rank["Rank_diff"] = weighted_metric_rank["Rank_trad"] -  weighted_metric_rank["Rank_w"]
@@ -432,9 +497,6 @@ def add_ranks(weighted_metric, traditional_metric):
     weighted_metric_rank = weighted_metric_rank[cols_to_move + [col for col in weighted_metric.columns if
                                                       col not in cols_to_move]]
     
-    # Sort values by weighted rank
-    weighted_metric_rank.sort_values("Rank_w", ascending=True, inplace=True)
-  
     return weighted_metric_rank  
 
 
@@ -471,7 +533,7 @@ def add_to_sql(df, table_name, engine):
 
 
 def create_weighted_metrics(connection, engine, season=None, suffix="",
-                            multiple_parts=False, pbp_table="mpbp"):
+                            multiple_parts=False, pbp_table="mpbp", n_jobs=1):
     """
     Create the weighted metrics for the given season and add them to the 
     SQL database.
@@ -489,6 +551,10 @@ def create_weighted_metrics(connection, engine, season=None, suffix="",
         an engine object such that we can use pd.to_sql() & pd.read_sql().
     suffix : string
         What to append at the end of the table name in the SQL database.
+    n_jobs : integer, default is 1
+        The number of threads used to calculate the metrics and to write 
+        them to the database. The writes check out their own connection
+        from the engine's pool.
 
     Returns
     -------
@@ -502,27 +568,51 @@ def create_weighted_metrics(connection, engine, season=None, suffix="",
     # Get the data with weighted reward
     df = get_data(connection, season, multiple_parts, pbp_table)
     
-    # Calculate goals and add player names + ranks
-    goals = add_ranks(add_names(calc_goals(df), connection), "Goals")
-    
-    # Calculate assists and add player names + ranks
-    assists = add_ranks(add_names(calc_assists(df), connection), "Assists")
-    
-    # Calculate first assists and add player names + ranks
-    first_assists = add_ranks(add_names(calc_first_assists(df), connection), "First_Assists")
+    # Get the names of all outfield players once for all metrics
+    skaters = get_skaters(connection)
+    
+    # The independent metrics and the functions used to calculate them
+    metric_functions = {"Goals": calc_goals, 
+                        "Assists": calc_assists, 
+                        "First_Assists": calc_first_assists, 
+                        "PlusMinus": calc_plus_minus}
+    
+    # Calculate the metric and add player names + ranks
+    def named_and_ranked(metric):
+        return add_ranks(add_names(metric_functions[metric](df), connection, skaters), 
+                         metric)
+    
+    if n_jobs == 1:
+        # Calculate each metric in turn
+        metrics = {metric: named_and_ranked(metric) for metric in metric_functions}
+    else:
+        # Calculate the metrics concurrently, the numba kernel and the 
+        # numpy/pandas aggregations release the GIL for most of their work
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            metrics = dict(zip(metric_functions, 
+                               executor.map(named_and_ranked, metric_functions)))
     
     # Calculate points and add player names + ranks
-    points = add_ranks(calc_points(goals, assists), "Points")
+    metrics["Points"] = add_ranks(calc_points(metrics["Goals"], metrics["Assists"]), 
+                                  "Points")
 
-    # Calculate plus-minus and add player names + ranks
-    plusminus = add_ranks(add_names(calc_plus_minus(df), connection), "PlusMinus")
+    # Name of the SQL table for each metric
+    tables = {"Goals": f"weighted_goals_ranked{suffix}",
+              "Assists": f"weighted_assists_ranked{suffix}",
+              "First_Assists": f"weighted_first_assists_ranked{suffix}",
+              "Points": f"weighted_points_ranked{suffix}",
+              "PlusMinus": f"weighted_plusminus_ranked{suffix}"}
 
     # Add tables to SQL    
-    add_to_sql(goals,     f"weighted_goals_ranked{suffix}",     engine)
-    add_to_sql(assists,   f"weighted_assists_ranked{suffix}",   engine)
-    add_to_sql(first_assists, f"weighted_first_assists_ranked{suffix}",   engine)
-    add_to_sql(points,    f"weighted_points_ranked{suffix}",    engine)
-    add_to_sql(plusminus, f"weighted_plusminus_ranked{suffix}", engine)
+    if n_jobs == 1:
+        for metric, table_name in tables.items():
+            add_to_sql(metrics[metric], table_name, engine)
+    else:
+        # The tables are independent, so they can be written concurrently
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(lambda metric: add_to_sql(metrics[metric], 
+                                                        tables[metric], engine), 
+                              tables))
 
 
 if __name__ == '__main__':
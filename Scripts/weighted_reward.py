@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*-
 # Author: Rasmus Säfvenberg
 
+import hashlib
+import logging
+import os
+from datetime import datetime
 import pandas as pd
 import numpy as np
+from contextlib import contextmanager
 from time import perf_counter
 from db import connect_to_db, create_db_engine
 from populateFields import extract_season
@@ -13,14 +18,188 @@ from weighted import create_weighted_metrics
 from matchlogsScraper import check_table_exists, add_gamelogs_to_db, \
     merge_id_and_date, create_pbp_view
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the peak memory is not reported
+    resource = None
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the timings are appended without a lock
+    fcntl = None
+
+# Logger for the progress and execution time of the stages
+log = logging.getLogger("weighted_reward")
+
+# Table with the hash of the arguments the mpbp and occurrences tables were 
+# created with
+CREATE_MPBP_META = """CREATE TABLE IF NOT EXISTS mpbp_meta 
+                      (params_hash CHAR(16), created DATETIME)"""
+
+# CSV file to append the stage timings to, in addition to the log. 
+# The default is None, i.e. only log them.
+PERF_FILE = None
+
+
+@contextmanager
+def timed_stage(name, suffix=""):
+    """
+    Log the wall time, CPU time and peak memory of a stage of the weighted 
+    reward calculation as a CSV line (name,suffix,wall,utime,stime,maxrss). 
+    As the stages mostly wait for the database, a wall time much larger than
+    the CPU time means that the stage is bound by SQL rather than Python.
+
+    Parameters
+    ----------
+    name : string
+        Name of the stage, e.g. "apply_reward".
+    suffix : string
+        The suffix of the tables created by the run the stage is part of.
+
+    Yields
+    ------
+    None. The timings are logged (and appended to PERF_FILE, if given) 
+    when the stage is finished.
+
+    """
+    # Time to see how long the stage takes
+    times_start = os.times()
+    time_start = perf_counter()
+    yield
+    wall = perf_counter() - time_start
+    times_end = os.times()
+    
+    # CPU time spent in Python (user) and in the system, e.g. on sockets
+    utime = times_end.user - times_start.user
+    stime = times_end.system - times_start.system
+    
+    # Peak memory of the process so far
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else ""
+    
+    line = f"{name},{suffix},{wall:.2f},{utime:.2f},{stime:.2f},{maxrss}"
+    log.info(line)
+    
+    # Store the timings for future comparisons
+    if PERF_FILE is not None:
+        with open(PERF_FILE, "a") as perf_file:
+            # Lock the file such that the lines of concurrent runs are not 
+            # interleaved, the lock is released when the file is closed
+            if fcntl is not None:
+                fcntl.flock(perf_file, fcntl.LOCK_EX)
+            perf_file.write(line + "\n")
+
+
+def parse_date(date):
+    """
+    Validate a date and convert it to an integer of format yyyymmdd, the 
+    format of the dates in the database.
+
+    Parameters
+    ----------
+    date : integer or string of format yyyymmdd, or None
+        The date to validate.
+
+    Returns
+    -------
+    date : integer value of format yyyymmdd, or None
+        The validated date, None if no date was given.
+
+    """
+    if date is None:
+        return None
+    
+    # Raises a ValueError if the date is not of format yyyymmdd
+    return int(datetime.strptime(str(date), "%Y%m%d").strftime("%Y%m%d"))
+
+
+def occurrences_hash(*args):
+    """
+    Hash the arguments that determine the mpbp and occurrences tables.
+
+    Parameters
+    ----------
+    *args : 
+        The arguments passed to extract_season and count_occurrences.
+
+    Returns
+    -------
+    params_hash : string
+        A hexadecimal hash of length 16 of the arguments.
+
+    """
+    params = "|".join([str(arg) for arg in args])
+    params_hash = hashlib.blake2b(params.encode(), digest_size=8).hexdigest()
+    
+    return params_hash
+
+
+def read_occurrences_hash(connection):
+    """
+    Get the hash of the arguments that the current mpbp and occurrences 
+    tables were created with.
+
+    Parameters
+    ----------
+    connection : MySQLconnection as created by db.connect_to_db
+        a connection to the SQL database we are working with.
+
+    Returns
+    -------
+    params_hash : string
+        The hash as stored by write_occurrences_hash, None if there is none.
+
+    """
+    # Create a cursor to executy queries
+    cursor = connection.cursor(buffered=True)
+    
+    # Create the table if it does not exist
+    cursor.execute(CREATE_MPBP_META)
+    
+    cursor.execute("SELECT params_hash FROM mpbp_meta LIMIT 1")
+    row = cursor.fetchone()
+    
+    return row[0] if row is not None else None
+
+
+def write_occurrences_hash(connection, params_hash):
+    """
+    Store the hash of the arguments that the current mpbp and occurrences 
+    tables were created with.
+
+    Parameters
+    ----------
+    connection : MySQLconnection as created by db.connect_to_db
+        a connection to the SQL database we are working with.
+    params_hash : string
+        The hash as returned by occurrences_hash. None to remove the 
+        stored hash, e.g. while the tables are being recreated.
+
+    Returns
+    -------
+    None. The related changes are instead pushed to the SQL database.
+
+    """
+    # Create a cursor to executy queries
+    cursor = connection.cursor(buffered=True)
+    
+    # Replace the stored hash
+    cursor.execute(CREATE_MPBP_META)
+    cursor.execute("DELETE FROM mpbp_meta")
+    if params_hash is not None:
+        cursor.execute("INSERT INTO mpbp_meta VALUES (%s, NOW())", (params_hash, ))
+    connection.commit()
+
 
 def apply_weighted_reward(season=None, suffix="", 
                           start_date=None, end_date=None,
                           create_copy=True, 
                           calc_occur=True,
-                          position_list=[],
+                          position_list=(),
                           multiple_parts=False, playoffs=False,
-                          evaluation_season=None, start_date_evaluation=None
+                          evaluation_season=None, start_date_evaluation=None,
+                          connection=None, engine=None, force_recompute=False
                           ):
     """
     Extract the season, calculate occurrences, apply the reward function and 
@@ -43,9 +222,9 @@ def apply_weighted_reward(season=None, suffix="",
     calc_occur : boolean
         Whether to create the mpbp table and calculate occurrences or simply
         apply the reward based on an already defined occurrences table.
-    position_list : list
-        A list of position(s) to calculate reward for.
-        Default is an empty list (i.e. all positions).
+    position_list : list or tuple
+        The position(s) to calculate reward for.
+        Default is an empty tuple (i.e. all positions).
     multiple_parts : boolean
         Whether to consider multiple seasons worth of data.
         The default is False.
@@ -58,6 +237,17 @@ def apply_weighted_reward(season=None, suffix="",
     start_date_evaluation : integer value of format yyyymmdd
         The date to start the valiation set at. Will be between
         start_date_evaluation and end_date.
+    connection : MySQLconnection as created by db.connect_to_db
+        a connection to the SQL database we are working with.
+        The default is None, in which case a new connection is created.
+    engine : sqlalchemy enginge as creadted by db.create_db_engine
+        an engine object such that we can use pd.to_sql() & pd.read_sql().
+        The default is None, in which case a new engine is created.
+    force_recompute : boolean
+        Whether to recreate the mpbp and occurrences tables even if they were 
+        last created with the same arguments (e.g. if they were changed by
+        running populateFields.py or outcomePerSecond.py directly).
+        The default is False.
     
     Returns
     -------
@@ -67,60 +257,89 @@ def apply_weighted_reward(season=None, suffix="",
     # Time to see how long the execution takes
     time_start = perf_counter()
     
-    # Create database connection and engine
-    connection = connect_to_db("hockey")
-    engine = create_db_engine("hockey")
+    # Validate the dates once, such that they are passed on as integers
+    start_date, end_date = parse_date(start_date), parse_date(end_date)
+    start_date_evaluation = parse_date(start_date_evaluation)
+    if start_date is not None and end_date is not None and start_date > end_date:
+        raise ValueError(f"start_date {start_date} is after end_date {end_date}.")
+    
+    # Create database connection and engine, unless given
+    if connection is None:
+        connection = connect_to_db("hockey")
+    if engine is None:
+        engine = create_db_engine("hockey")
     
     # Check if the table gamelogs exists
     table_exists = check_table_exists(connection, "gamelogs")
     
     if not table_exists:
-        print("Creating table gamelogs")
-        # Get all the gamelogs and add them to the database 
-        add_gamelogs_to_db(connection, engine)
+        with timed_stage("add_gamelogs_to_db"):
+            # Get all the gamelogs and add them to the database 
+            add_gamelogs_to_db(connection, engine)
+        
+            # Merge the GameId and dates
+            merge_id_and_date(connection, engine)
+        
+    #Check if the materialized view 'pbp_mat' already exists
+    view_exists = check_table_exists(connection, tablename="pbp_mat")
     
-        # Merge the GameId and dates
-        merge_id_and_date(connection, engine)
+    # Refresh it whenever the gamelogs (and thereby the dates) were just added
+    if not view_exists or not table_exists:    
+        with timed_stage("create_pbp_view"):
+            # Creat a materialized view for the play by play data 
+            create_pbp_view(connection)
         
-    #Check if the view 'pbp_view' already exists
-    view_exists = check_table_exists(connection, tablename="pbp_view")
+        # The mpbp table has to be recreated from the new play by play data
+        write_occurrences_hash(connection, None)
     
-    if not view_exists:    
-        print("Creating view pbp_view")
-        # Creat a view for the play by play data 
-        create_pbp_view(connection)
+    # Hash of the arguments that determine the mpbp and occurrences tables
+    params_hash = occurrences_hash(season, start_date, end_date, 
+                                   multiple_parts, playoffs,
+                                   evaluation_season, start_date_evaluation)
     
-    if calc_occur:
-        # Extract the season
-        extract_season(connection, engine, season, 
-                       start_date, end_date, 
-                       multiple_parts, playoffs,
-                       evaluation_season, start_date_evaluation)
+    # The tables are already up to date if they were created with the same arguments
+    if calc_occur and not force_recompute and \
+        read_occurrences_hash(connection) == params_hash:
+        log.info("mpbp cache hit %s", suffix)
+    elif calc_occur:
+        # The tables are not valid until they have been recreated
+        write_occurrences_hash(connection, None)
+        
+        with timed_stage("extract_season", suffix):
+            # Extract the season
+            extract_season(connection, engine, season, 
+                           start_date, end_date, 
+                           multiple_parts, playoffs,
+                           evaluation_season, start_date_evaluation)
     
-        print("Counting occurrences...")
-        # Count occurrences
-        count_occurrences(connection, engine, multiple_parts)
+        with timed_stage("count_occurrences", suffix):
+            # Count occurrences
+            count_occurrences(connection, engine, multiple_parts)
+        
+        # Store the arguments the tables were created with
+        write_occurrences_hash(connection, params_hash)
         
-    print("Applying reward...")
-    # Apply the reward function
-    apply_reward(connection, engine, position_list)
+    with timed_stage("apply_reward", suffix):
+        # Apply the reward function
+        apply_reward(connection, engine, position_list)
 
     # Create copies of the desired tables
     if create_copy and suffix != "": 
-        create_table_copy(connection, suffix)
+        with timed_stage("create_table_copy", suffix):
+            create_table_copy(connection, suffix)
     
-    print("Creating weighted metrics...")
-    # Calculate and create the weighted metrics and push to SQL
-    create_weighted_metrics(connection, engine, season, suffix,
-                            multiple_parts)
+    with timed_stage("create_weighted_metrics", suffix):
+        # Calculate and create the weighted metrics and push to SQL
+        create_weighted_metrics(connection, engine, season, suffix,
+                                multiple_parts)
     
     # End of execution
     time_end = perf_counter()
     
-    print(f"Finished! Execution time: {time_end-time_start:.2f} seconds.")
+    log.info("apply_weighted_reward %s %.2fs", suffix, time_end - time_start)
     
 
-def partitioned_season(season, n_partitions):
+def partitioned_season(season, n_partitions, connection=None):
     """
     Get the dates for diving a season into 1, ..., n_partitions partitions
     of approximately equal size. The function will create a sequence of 
@@ -133,6 +352,9 @@ def partitioned_season(season, n_partitions):
         Valid inputs are 2007 - 2014.
     n_partitions : integer
         The maximum number of partitions to consider.
+    connection : MySQLconnection as created by db.connect_to_db
+        a connection to the SQL database we are working with.
+        The default is None, in which case a new connection is created.
 
     Returns
     -------
@@ -141,50 +363,59 @@ def partitioned_season(season, n_partitions):
                                                               end: date}}}.
 
     """
-    # Create database connection
-    connection = connect_to_db("hockey")
+    # Create database connection, unless given
+    if connection is None:
+        connection = connect_to_db("hockey")
     
     # Get all the dates and the number of games per date
-    query = f"""SELECT date, Count(Distinct(GameId)) AS Count FROM pbp_view 
-                WHERE GameId LIKE '{season}02%' GROUP BY date"""
-    date_count = pd.read_sql(query, con=connection)
+    query = """SELECT date, Count(Distinct(GameId)) AS Count FROM pbp_mat 
+               WHERE GameId LIKE %s GROUP BY date"""
+    date_count = pd.read_sql(query, con=connection, params=(f"{season}02%",))
+    
+    # Count the cumulative sum of the number of games per date
+    cumcount = np.cumsum(date_count["Count"].to_numpy())
+    dates = date_count["date"].to_numpy(dtype=np.int64)
     
     # Initiate a dictionary for storing the results
     partition_dict = {}
     
     # Loop over all partitions from 1 until the desired number of partitions
     for partition_number in range(1, n_partitions + 1):
-        # Start date of the first partition
-        partition_start_date = int(date_count.loc[0, "date"])
-    
-        # Get the approximate size of the partitions
-        partition_size = sum(date_count["Count"]) / partition_number
-    
-        # Count the cumulative sum of the number of games per date
-        date_count["CumCount"] = np.cumsum(date_count["Count"])
+        # Get the approximate size of the partitions and the desired 
+        # cumulative number of games at the end of each partition
+        partition_size = cumcount[-1] / partition_number
+        targets = np.arange(1, partition_number + 1) * partition_size
         
-        # Store the results for the current number of partitions
-        partition_dict[partition_number] = {}
+        # Find the dates which are closest to the desired partition sizes, 
+        # i.e. the first date reaching the size or the date before it
+        date_argmin = np.searchsorted(cumcount, targets)
+        reaching = cumcount[np.minimum(date_argmin, len(cumcount) - 1)]
+        before = cumcount[np.maximum(date_argmin - 1, 0)]
+        use_before = (date_argmin == len(cumcount)) | \
+            ((date_argmin > 0) & (targets - before <= reaching - targets))
+        date_argmin = np.where(use_before, date_argmin - 1, date_argmin)
         
-        for i in range(1, partition_number + 1):
-            # Find the date which is closest to the desired partition size
-            date_argmin = np.argmin(abs(date_count["CumCount"] - i * partition_size))
-            
-            # Get the end date for the partition
-            partition_end_date = int(date_count.loc[date_argmin, "date"])
-            
-            # Store the start and end date for the givne partition
-            partition_dict[partition_number][f"part{i}"] = {"start": partition_start_date, 
-                                                            "end": partition_end_date}
-            
-            # Update the starting date
-            partition_start_date = int(partition_end_date) + 1
+        # Get the end dates for the partitions, each partition starts the
+        # day after the previous one ended
+        partition_end_dates = dates[date_argmin]
+        next_dates = pd.to_datetime(partition_end_dates[:-1].astype(str), format="%Y%m%d") + \
+            pd.Timedelta(days=1)
+        partition_start_dates = np.r_[dates[0], 
+                                      next_dates.strftime("%Y%m%d").astype(np.int64)]
+        
+        # Store the start and end date for the given number of partitions
+        partition_dict[partition_number] = {
+            f"part{i}": {"start": int(start), "end": int(end)} 
+            for i, (start, end) in enumerate(zip(partition_start_dates, 
+                                                 partition_end_dates), start=1)}
 
     return partition_dict
 
     
 if __name__ == "__main__":
-    print("---Started execution---")
+    # Log the progress with a time stamp
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    log.info("---Started execution---")
 
     ### Input arguments
     full_season = False
@@ -193,76 +424,92 @@ if __name__ == "__main__":
     multiple_seasons = False
     multiple_parts = False
 
-    ######################### --- Full season --- #############################
-    if full_season:
-        # Main code    
-        for season in range(2007, 2014):
-            apply_weighted_reward(season=season, suffix=f"{season}", 
-                                  create_copy=True,
-                                  multiple_parts=False, playoffs=False) 
+    # Create a database connection and engine shared by all runs, where the
+    # pooled connections are checked before reuse during the long runs
+    connection = connect_to_db("hockey")
+    engine = create_db_engine("hockey", pool_pre_ping=True)
+    
+    try:
+        ######################### --- Full season --- #############################
+        if full_season:
+            # Main code    
+            for season in range(2007, 2014):
+                apply_weighted_reward(season=season, suffix=f"{season}", 
+                                      create_copy=True,
+                                      multiple_parts=False, playoffs=False,
+                                      connection=connection, engine=engine) 
             
-    ######################### --- Playoffs --- #############################
-    if playoffs_seasons:
-        # Main code    
-        for season in range(2007, 2014):
-            apply_weighted_reward(season=season, suffix=f"{season}_playoffs", 
-                                  create_copy=True,
-                                  multiple_parts=False, playoffs=True) 
+        ######################### --- Playoffs --- #############################
+        if playoffs_seasons:
+            # Main code    
+            for season in range(2007, 2014):
+                apply_weighted_reward(season=season, suffix=f"{season}_playoffs", 
+                                      create_copy=True,
+                                      multiple_parts=False, playoffs=True,
+                                      connection=connection, engine=engine) 
         
     
-    #################### --- Partitioned season --- ###########################
-    if partitioned_seasons:
-        # Input arguments
-        n_partitions = 10
+        #################### --- Partitioned season --- ###########################
+        if partitioned_seasons:
+            # Input arguments
+            n_partitions = 10
         
-        # Main code
-        for season in range(2007, 2014):
-            partition_dict = partitioned_season(season, n_partitions)
-            for partition in range(2, n_partitions+1): # Skip the full season
-                print(f"Partition: {partition}")
-                for part in partition_dict[partition]:
-                    print(f"{season}_{partition}partitions_part{part[4:]}")
-                    # Start and end date of the partitions
-                    start_date_part = partition_dict[partition][part]["start"]
-                    end_date_part = partition_dict[partition][part]["end"]
-                    # Compute the reward
-                    apply_weighted_reward(season=None,
-                                          suffix=f"{season}_{partition}partitions_part{part[-1]}", 
-                                          start_date=start_date_part, 
-                                          end_date=end_date_part,
-                                          create_copy=True, 
-                                          multiple_parts=False, playoffs=False)
+            # Main code
+            for season in range(2007, 2014):
+                partition_dict = partitioned_season(season, n_partitions, connection)
+                for partition in range(2, n_partitions+1): # Skip the full season
+                    log.info("Partition: %s", partition)
+                    for part in partition_dict[partition]:
+                        log.info("%s_%spartitions_part%s", season, partition, part[4:])
+                        # Start and end date of the partitions
+                        start_date_part = partition_dict[partition][part]["start"]
+                        end_date_part = partition_dict[partition][part]["end"]
+                        # Compute the reward
+                        apply_weighted_reward(season=None,
+                                              suffix=f"{season}_{partition}partitions_part{part[-1]}", 
+                                              start_date=start_date_part, 
+                                              end_date=end_date_part,
+                                              create_copy=True, 
+                                              multiple_parts=False, playoffs=False,
+                                              connection=connection, engine=engine)
             
     
-    ##################### --- Multiple parts --- ############################
-    # Multiple seasons
-    if multiple_seasons:
-        # Input arguments
-        start_season = 2007
-        evaluation_season = 2013
+        ##################### --- Multiple parts --- ############################
+        # Multiple seasons
+        if multiple_seasons:
+            # Input arguments
+            start_season = 2007
+            evaluation_season = 2013
+        
+            # Main code - Full seasons
+            apply_weighted_reward(season=start_season, 
+                                  suffix=f"{start_season}_{evaluation_season}", 
+                                  create_copy=True, multiple_parts=True,
+                                  playoffs=False, evaluation_season=evaluation_season,
+                                  connection=connection, engine=engine) 
         
-        # Main code - Full seasons
-        apply_weighted_reward(season=start_season, 
-                              suffix=f"{start_season}_{evaluation_season}", 
-                              create_copy=True, multiple_parts=True,
-                              playoffs=False, evaluation_season=evaluation_season) 
+            # Main code - playoffs
+            apply_weighted_reward(season=start_season, 
+                                  suffix=f"{start_season}_{evaluation_season}_playoffs", 
+                                  create_copy=True, multiple_parts=True,
+                                  playoffs=True, evaluation_season=evaluation_season,
+                                  connection=connection, engine=engine) 
         
-        # Main code - playoffs
-        apply_weighted_reward(season=start_season, 
-                              suffix=f"{start_season}_{evaluation_season}_playoffs", 
-                              create_copy=True, multiple_parts=True,
-                              playoffs=True, evaluation_season=evaluation_season) 
+        # Multiple parts within a season
+        if multiple_parts:
+            # Input arguments
+            start_date = 20131001
+            end_date = 20140713
+            start_date_evaluation = 20140418
         
-    # Multiple parts within a season
-    if multiple_parts:
-        # Input arguments
-        start_date = 20131001
-        end_date = 20140713
-        start_date_evaluation = 20140418
+            # Main code
+            apply_weighted_reward(suffix=f"{start_date}_{end_date}_{start_date_evaluation}_eval",
+                                  start_date=start_date, end_date=end_date,
+                                  create_copy=True, multiple_parts=True,
+                                  start_date_evaluation=start_date_evaluation,
+                                  connection=connection, engine=engine)
         
-        # Main code
-        apply_weighted_reward(suffix=f"{start_date}_{end_date}_{start_date_evaluation}_eval",
-                              start_date=start_date, end_date=end_date,
-                              create_copy=True, multiple_parts=True,
-                              start_date_evaluation=start_date_evaluation)
-        
\ No newline at end of file
+    finally:
+        # Close the connection and dispose of the engine
+        connection.close()
+        engine.dispose()